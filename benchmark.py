@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Pender hook latency benchmark.
+
+Builds throwaway repositories with a given number and mix of staged files,
+runs the pre-commit hook in each against stub plugins with a fixed cost, and
+reports end-to-end and per-phase latency. Results can be saved as JSON and
+compared with an earlier run to catch regressions.
+
+Example:
+    ./benchmark.py --files 1,10,100 --output after.json --baseline before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+HOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'pre-commit.py')
+# Extensions each stub plugin applies to. Binary files only get the catch-all
+STUB_PLUGINS = {
+    'stub_python': '.py',
+    'stub_puppet': '.pp',
+    'stub_ruby': '.rb .erb',
+    'stub_all': '',
+}
+STUB_PLUGIN = '''#!/usr/bin/env python
+"""Benchmark stub plugin.
+%(header)s
+"""
+import os
+import sys
+import time
+
+if sys.argv[1] == 'check':
+    end = time.time() + int(os.environ.get('PENDER_cpu_ms', 0)) / 1000.0
+    while time.time() < end:
+        pass
+    time.sleep(int(os.environ.get('PENDER_sleep_ms', 0)) / 1000.0)
+sys.exit(0)
+'''
+# Filler lines for each file type, formatted with the line number
+FILE_LINES = {
+    'py': 'value_%d = %d\n',
+    'pp': "notify { 'message %d': message => '%d' }\n",
+    'rb': 'value_%d = %d\n',
+    'erb': '<%%= %d + %d %%>\n',
+}
+# Lines between the two changed hunks in partially staged files
+PARTIAL_MIN_LINES = 20
+PHASES = ('pre-commit', 'load_config', 'changed_files', 'staged_blobs',
+          'detect_mime_types', 'changed_lines', 'create_temp_files', 'checks')
+# Caches under .git/pender/ emptied before each run unless --warm. The parsed
+# config is kept, as it's only out of date after pre-commit.yaml changes.
+CHECK_CACHES = ('results', 'mime-types')
+
+
+def git(repo, *args, **kwargs):
+    """Run a git command in repo, failing loudly."""
+    stdin = kwargs.pop('stdin', None)
+    process = subprocess.Popen(('git', ) + args, cwd=repo,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate(stdin)[0]
+    if process.returncode != 0:
+        raise RuntimeError("git %s failed: %s" % (' '.join(args), output))
+    return output
+
+
+def parse_mix(value):
+    """Parse a file type mix like 'py=4,rb=1' into [(type, weight)]."""
+    mix = []
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in FILE_LINES and name != 'bin':
+            raise argparse.ArgumentTypeError("Unknown file type %r" % name)
+        try:
+            mix.append((name, int(weight or 1)))
+        except ValueError:
+            raise argparse.ArgumentTypeError("Invalid weight %r" % weight)
+    return mix
+
+
+def parse_counts(value):
+    """Parse a comma-separated list of file counts."""
+    try:
+        return [int(count) for count in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid file counts %r" % value)
+
+
+def file_types(count, mix):
+    """Return count file types, spread according to the mix."""
+    pattern = [name for name, weight in mix for _ in range(weight)]
+    return [pattern[i % len(pattern)] for i in range(count)]
+
+
+def file_content(file_type, size, rng):
+    """Return about size bytes of content for a file type."""
+    if file_type == 'bin':
+        return ''.join(chr(rng.randint(0, 255)) for _ in range(size))
+    lines = []
+    length = 0
+    while length < size or len(lines) < PARTIAL_MIN_LINES:
+        lines.append(FILE_LINES[file_type] % (len(lines), rng.randint(0, 99)))
+        length += len(lines[-1])
+    return ''.join(lines)
+
+
+def build_repo(path, count, args):
+    """Create a repository at path with count staged files."""
+    rng = random.Random(args.seed)
+    os.makedirs(os.path.join(path, 'plugins'))
+    git(path, 'init', '-q', '.')
+    git(path, 'config', 'user.email', 'benchmark@example.com')
+    git(path, 'config', 'user.name', 'Pender benchmark')
+    for name, extensions in STUB_PLUGINS.iteritems():
+        plugin_path = os.path.join(path, 'plugins', name + '.py')
+        with open(plugin_path, 'w') as f:
+            f.write(STUB_PLUGIN % {
+                'header': extensions and '\npender-extensions: ' + extensions})
+        os.chmod(plugin_path, 0755)
+    plugin_config = {'cpu_ms': str(args.cpu_ms),
+                     'sleep_ms': str(args.sleep_ms)}
+    with open(os.path.join(path, 'pre-commit.yaml'), 'w') as f:
+        json.dump({
+            'pender': {'plugin_dir': 'plugins/', 'cache': args.warm},
+            'plugins': dict((name, plugin_config) for name in STUB_PLUGINS),
+        }, f, indent=4)
+    # Installed as in README, so the hook's update check passes
+    shutil.copy(HOOK, os.path.join(path, 'pre-commit.py'))
+    shutil.copy(HOOK, os.path.join(path, '.git', 'hooks', 'pre-commit'))
+
+    # Partially staged files need a committed version with two hunks of
+    # changes, of which `git add -p` stages only the first
+    files = []
+    partial = []
+    for num, file_type in enumerate(file_types(count, args.mix)):
+        name = os.path.join('dir%d' % (num % 10), 'file%d.%s' % (num,
+                                                                 file_type))
+        content = file_content(file_type, args.size, rng)
+        if file_type != 'bin' and rng.random() < args.partial:
+            partial.append((name, content))
+        else:
+            files.append((name, content))
+    for name, content in partial:
+        write_file(path, name, content)
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '--no-verify', '-m', 'Benchmark base')
+    for name, content in files:
+        write_file(path, name, content)
+    for name, content in partial:
+        lines = content.splitlines(True)
+        lines[0] = '# staged\n' + lines[0]
+        lines[-1] += '# not staged\n'
+        write_file(path, name, ''.join(lines))
+    if files:
+        git(path, 'add', '--', *[name for name, _ in files])
+    if partial:
+        git(path, '-c', 'interactive.singleKey=false', 'add', '-p', '--',
+            *[name for name, _ in partial], stdin='y\nn\n' * len(partial))
+    return len(partial)
+
+
+def write_file(repo, name, content):
+    """Write a file in the repository, creating its directory."""
+    path = os.path.join(repo, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def run_hook(repo, args):
+    """Run the hook once, returning (seconds, trace events)."""
+    trace_path = os.path.join(repo, '.git', 'benchmark-trace.json')
+    env = dict(os.environ, GIT_DIR='.git', PENDER_TRACE=trace_path)
+    env.pop('PENDER_DEBUG', None)
+    if args.jobs:
+        env['PENDER_JOBS'] = str(args.jobs)
+    if not args.warm:
+        for name in CHECK_CACHES:
+            path = os.path.join(repo, '.git', 'pender', name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.unlink(path)
+    start = time.time()
+    process = subprocess.Popen(
+        [args.python, os.path.join('.git', 'hooks', 'pre-commit')], cwd=repo,
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    elapsed = time.time() - start
+    if process.returncode != 0:
+        raise RuntimeError("Hook failed (%s):\n%s" %
+                           (process.returncode, output))
+    with open(trace_path) as f:
+        events = json.load(f)['traceEvents']
+    os.unlink(trace_path)
+    return elapsed, events
+
+
+def summarise(samples):
+    """Return the median, min and max of samples in milliseconds."""
+    samples = sorted(samples)
+    middle = len(samples) // 2
+    if len(samples) % 2:
+        median = samples[middle]
+    else:
+        median = (samples[middle - 1] + samples[middle]) / 2.0
+    return {'median_ms': round(median * 1000, 3),
+            'min_ms': round(samples[0] * 1000, 3),
+            'max_ms': round(samples[-1] * 1000, 3)}
+
+
+def benchmark(count, args):
+    """Benchmark the hook with count staged files."""
+    repo = tempfile.mkdtemp(prefix='pender-benchmark-')
+    try:
+        partial = build_repo(repo, count, args)
+        run_hook(repo, args)  # Untimed, to save the parsed config
+        totals = []
+        phases = dict((name, []) for name in PHASES + ('plugins', ))
+        plugin_runs = 0
+        for _ in range(args.runs):
+            elapsed, events = run_hook(repo, args)
+            totals.append(elapsed)
+            plugin_time = 0
+            for event in events:
+                if event['name'] in PHASES:
+                    phases[event['name']].append(event['dur'] / 1e6)
+                elif event['name'] != 'throttled':
+                    plugin_time += event['dur'] / 1e6
+                    plugin_runs += 1
+            phases['plugins'].append(plugin_time)
+    finally:
+        shutil.rmtree(repo)
+    return {
+        'files': count,
+        'partial_files': partial,
+        'plugin_runs': plugin_runs // args.runs,
+        'total': summarise(totals),
+        'phases': dict((name, summarise(samples))
+                       for name, samples in phases.iteritems() if samples),
+    }
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """Return regressions between baseline and results as strings.
+
+    A median slower by more than threshold (a fraction) and min_delta_ms is a
+    regression.
+    """
+    regressions = []
+    old_results = dict((result['files'], result)
+                       for result in baseline['results'])
+    for result in results['results']:
+        old = old_results.get(result['files'])
+        if old is None:
+            continue
+        timings = [('total', result['total'], old['total'])]
+        timings.extend((name, timing, old['phases'][name])
+                       for name, timing in sorted(result['phases'].items())
+                       if name in old['phases'])
+        for name, new_timing, old_timing in timings:
+            new_ms = new_timing['median_ms']
+            old_ms = old_timing['median_ms']
+            if new_ms > old_ms * (1 + threshold) and \
+                    new_ms - old_ms > min_delta_ms:
+                regressions.append(
+                    "%d files: %s %.1fms -> %.1fms (%+.0f%%)" % (
+                        result['files'], name, old_ms, new_ms,
+                        (new_ms / old_ms - 1) * 100 if old_ms else 100))
+    return regressions
+
+
+def print_results(results):
+    """Print a table of median timings."""
+    columns = ('total', ) + PHASES[1:] + ('plugins', )
+    print("%6s %8s" % ('files', 'runs') +
+          ''.join(' %17s' % name for name in columns))
+    for result in results['results']:
+        timings = [result['total']] + [result['phases'].get(name, {})
+                                       for name in columns[1:]]
+        print("%6d %8d" % (result['files'], result['plugin_runs']) +
+              ''.join(' %15.1fms' % timing['median_ms'] if timing else
+                      ' %17s' % '-' for timing in timings))
+    print("Median of %d runs. 'runs' is plugin runs per hook run, 'plugins' "
+          "their summed time." % results['settings']['runs'])
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark Pender pre-commit hook latency.")
+    parser.add_argument('--files', type=parse_counts, default=[1, 10, 100],
+                        help="comma-separated staged file counts to test "
+                        "(default 1,10,100)")
+    parser.add_argument('--size', type=int, default=2048,
+                        help="approximate size of each file in bytes "
+                        "(default 2048)")
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('py=4,pp=2,rb=2,erb=1,bin=1'),
+                        help="file type weights, from py, pp, rb, erb and "
+                        "bin (default py=4,pp=2,rb=2,erb=1,bin=1)")
+    parser.add_argument('--partial', type=float, default=0.2,
+                        help="fraction of text files only partly staged with "
+                        "`git add -p` (default 0.2)")
+    parser.add_argument('--cpu-ms', type=int, default=0,
+                        help="CPU time each stub plugin check burns")
+    parser.add_argument('--sleep-ms', type=int, default=0,
+                        help="time each stub plugin check sleeps")
+    parser.add_argument('--jobs', type=int,
+                        help="PENDER_JOBS for the hook (default: its own)")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="hook runs per file count (default 5)")
+    parser.add_argument('--warm', action='store_true',
+                        help="enable and keep Pender's check caches between "
+                        "runs")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed for file contents")
+    parser.add_argument('--python', default=sys.executable,
+                        help="interpreter to run the hook with")
+    parser.add_argument('--output', help="save results as JSON to this file")
+    parser.add_argument('--baseline',
+                        help="compare with results saved by an earlier run, "
+                        "exiting 1 if any median regressed")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="fraction slower than the baseline that counts "
+                        "as a regression (default 0.1)")
+    parser.add_argument('--min-delta-ms', type=float, default=5,
+                        help="ignore regressions smaller than this "
+                        "(default 5)")
+    args = parser.parse_args()
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+    return args
+
+
+def main():
+    """Main application."""
+    args = parse_args()
+    settings = dict((key, value) for key, value in vars(args).iteritems()
+                    if key not in ('output', 'baseline', 'python'))
+    results = {
+        'settings': settings,
+        'environment': {
+            'python': subprocess.check_output(
+                [args.python, '-c', 'import platform; '
+                 'print(platform.python_version())']).strip(),
+            'git': git('.', '--version').strip(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': [],
+    }
+    for count in args.files:
+        results['results'].append(benchmark(count, args))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != json.loads(json.dumps(settings)):
+            print("Warning: baseline was run with different settings")
+        regressions = compare(results, baseline, args.threshold,
+                              args.min_delta_ms)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@
 
 # A Pender plugin to lint JS files. Uses jshint.
 # There are no configuration options.
+#
+# pender-extensions: .js .jsx
 
 case $1 in
     install)
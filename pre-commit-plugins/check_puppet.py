@@ -2,6 +2,8 @@
 """Pender plugin to check Puppet files using puppet syntax and puppet-lint.
 
 There are no configuration options.
+
+pender-extensions: .pp
 """
 
 # CHECK CONFIG
@@ -18,12 +18,42 @@ Configuration:
     pep257_ignored_codes: Comma-separated list of pep257 error codes to be
         ignored. Default: D203 (conflicts with yapf).
     yapf_style: See `yapf --style` documentation.
+    linter_jobs: How many linters to run at once. Default: the number of
+        CPUs divided by the number of checks Pender runs at once.
+    changed_lines_only: Only report pylint, pep8 and pep257 problems on lines
+        changed since HEAD. Syntax errors are always reported. Default False.
+
+The use_* and changed_lines_only options are on when set to yes, true or 1
+(in any case), and off when set to anything else.
+
+yapf only checks the lines changed since HEAD (using Pender's changed-lines
+input), so a small edit to a large file isn't held up by the layout of the
+rest of it.
+
+Syntax, pep8 and pep257 checks are run in-process on the already-read source
+when the pep8 and pep257 modules can be imported, falling back to running the
+tools.
+
+Supports Pender's check-batch action, linting all files with one run of each
+tool, and the serve action.
+
+pender-actions: check-batch, serve
+pender-inputs: changed-lines
+pender-extensions: .py
+pender-mime-types: text/x-python
 """
 
 import os
+import re
 import sys
+import json
+import tokenize
+import threading
+import py_compile
 import subprocess
+import multiprocessing
 import distutils.spawn
+from StringIO import StringIO
 
 ################
 # Real constants
@@ -32,51 +62,336 @@ PENDER_OK = 0
 PENDER_VETO = 10
 PENDER_ERR = 1
 DEBUG = True if 'PENDER_DEBUG' in os.environ else False
+# Line number at the start of a problem (after any 'path:' prefix)
+PROBLEM_LINE_RE = re.compile(r'^\s*(\d+)\b')
 
 
-def check_lint(name, args, strip_first_line=False, output_is_error=False):
-    """Call a Python linter and print problems that are found.
+def run_lint(name, args, strip_first_line=False, output_is_error=False):
+    """Call a Python linter and return (success, problem lines).
 
     strip_first_line:
         Strip the first line from output (for pylint)
     output_is_error:
         Assume output means lint failure (rather than non-zero exit) (for yapf)
 
-    Return boolean success.
+    Raises OSError if the linter can't be started.
     """
     if DEBUG:
         print('check_linter', name, args, strip_first_line, output_is_error)
-    success = True
+    p = subprocess.Popen(args,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    stdout, _ = p.communicate()
+    if p.returncode or (output_is_error and stdout.strip()):
+        lines = stdout.splitlines()
+        if strip_first_line:
+            lines = lines[1:]
+        return False, lines
+    return True, []
+
+
+# Linter modules imported so far: name: module, or None if not installed
+LINTER_MODULES = {}
+
+
+def import_linter(name):
+    """Return the named linter module, or None if it isn't installed."""
+    if name not in LINTER_MODULES:
+        try:
+            LINTER_MODULES[name] = __import__(name)
+        except ImportError:
+            LINTER_MODULES[name] = None
+    return LINTER_MODULES[name]
+
+
+def compile_source(source, temp_file, _):
+    """Check syntax like `python -m py_compile` does.
+
+    Return (success, problem lines).
+    """
+    source = source.replace('\r\n', '\n').replace('\r', '\n')
+    if source and not source.endswith('\n'):
+        source += '\n'
     try:
-        p = subprocess.Popen(args,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-    except OSError as e:
-        print("Couldn't start %s, skipping ('%s')" % (name, e))
-    else:
-        stdout, _ = p.communicate()
-        if p.returncode or (output_is_error and stdout.strip()):
-            print("%s problems:" % name)
-            lines = stdout.splitlines()
-            if strip_first_line:
-                lines = lines[1:]
-            for line in lines:
-                print('    {}'.format(line))
-            success = False
+        compile(source, temp_file, 'exec')
+    except Exception as e:  # pylint: disable=broad-except
+        error = py_compile.PyCompileError(type(e), e, temp_file)
+        return False, (error.msg + '\n').splitlines()
+    return True, []
+
+
+def pep8_source(source, temp_file, args):
+    """Check source with the pep8 module, using the pep8 command's args.
+
+    Return (success, problem lines), or None if pep8 isn't installed.
+    """
+    pep8 = import_linter('pep8')
+    if not pep8:
+        return None
+    problems = []
+
+    class Report(pep8.StandardReport):
+        """Collects problems instead of printing them."""
+
+        def get_file_results(self):
+            """Format problems like StandardReport, and return the count."""
+            self._deferred_print.sort()
+            for line_number, offset, code, text, _ in self._deferred_print:
+                problems.append(self._fmt % {
+                    'path': self.filename,
+                    'row': self.line_offset + line_number,
+                    'col': offset + 1,
+                    'code': code,
+                    'text': text,
+                })
+            return self.file_errors
+
+    # Parse args just as the pep8 command would
+    style = pep8.StyleGuide(paths=args[1:] + [temp_file])
+    lines = source.replace('\r\n', '\n').replace('\r', '\n')
+    checker = pep8.Checker(temp_file,
+                           lines=lines.splitlines(True),
+                           options=style.options,
+                           report=Report(style.options))
+    return not checker.check_all(), problems
+
+
+def pep257_source(source, temp_file, args):
+    """Check source with the pep257 module, using the pep257 command's args.
+
+    Return (success, problem lines), or None if pep257 isn't installed.
+    """
+    pep257 = import_linter('pep257')
+    if not pep257:
+        return None
+    ignored = set()
+    for arg in args:
+        if arg.startswith('--ignore='):
+            ignored.update(arg.split('=', 1)[1].split(','))
+    checked = set(pep257.ErrorRegistry.get_error_codes()) - ignored
+    problems = []
+    try:
+        for error in pep257.PEP257Checker().check_source(source, temp_file):
+            if getattr(error, 'code', None) in checked:
+                problems.append(str(error))
+    except (EnvironmentError, pep257.AllError) as e:
+        problems.append(str(e))
+    except tokenize.TokenError:
+        problems.append('invalid syntax in file %s' % temp_file)
+    return not problems, '\n'.join(problems).splitlines()
+
+
+# Linters which can check already-read source: name: function(source,
+# temp_file, args)
+IN_PROCESS_LINTERS = {
+    'python': compile_source,
+    'pep8': pep8_source,
+    'pep257': pep257_source,
+}
+
+
+def in_process(name):
+    """Return whether the named linter can be run in-process."""
+    if name not in IN_PROCESS_LINTERS:
+        return False
+    # Only the compiler is built in
+    return name == 'python' or import_linter(name) is not None
+
+
+def lint(name, args, options, temp_file, source):
+    """Run a linter on a file, in-process if possible.
+
+    Return (success, problem lines). Raises OSError if the linter has to be
+    run as a command and can't be started.
+    """
+    if name in IN_PROCESS_LINTERS:
+        result = IN_PROCESS_LINTERS[name](source, temp_file, args)
+        if result is not None:
+            return result
+    return run_lint(name, args + [temp_file], **options)
+
+
+def read_source(temp_file):
+    """Return the contents of temp_file."""
+    with open(temp_file, 'rb') as f:
+        return f.read()
+
+
+def parse_changed_lines(value):
+    """Parse Pender's 'first-last,...' changed lines into [(first, last)].
+
+    Return None (the whole file) if value is unset.
+    """
+    if value is None:
+        return None
+    return [tuple(int(number) for number in line_range.split('-'))
+            for line_range in value.split(',') if line_range]
+
+
+def yapf_lines(args, changed_lines):
+    """Return yapf args limited to changed_lines (if not None)."""
+    if changed_lines is None:
+        return args
+    return args + ['--lines=%d-%d' % tuple(line_range)
+                   for line_range in changed_lines]
+
+
+def on_changed_lines(lines, temp_file, changed_lines):
+    """Return the problem lines about changed_lines.
+
+    Lines without a line number belong to the problem above them.
+    """
+    kept = []
+    keep = True
+    for line in lines:
+        if line.startswith(temp_file + ':'):
+            match = PROBLEM_LINE_RE.match(line[len(temp_file) + 1:])
+        else:
+            match = PROBLEM_LINE_RE.match(line)
+        if match:
+            number = int(match.group(1))
+            keep = any(first <= number <= last
+                       for first, last in changed_lines)
+        if keep:
+            kept.append(line)
+    return kept
+
+
+def filter_problems(name, lines, temp_file, changed_lines, config):
+    """Apply the changed_lines_only option to a linter's problem lines."""
+    if not config['changed_lines_only'] or changed_lines is None or \
+            name in ('python', 'yapf'):
+        return lines
+    return on_changed_lines(lines, temp_file, changed_lines)
+
+
+def print_lint(name, result):
+    """Print the problems a linter found.
+
+    result is run_lint's return value, or the OSError it raised.
+
+    Return boolean success.
+    """
+    if isinstance(result, OSError):
+        print("Couldn't start %s, skipping ('%s')" % (name, result))
+        return True
+    success, lines = result
+    if not success:
+        print("%s problems:" % name)
+        for line in lines:
+            print('    {}'.format(line))
     return success
 
 
+def run_concurrently(calls, jobs):
+    """Make (function, args, kwargs) calls using up to jobs threads.
+
+    Return the results in order. An OSError raised by a call is returned in
+    place of its result.
+    """
+    results = [None] * len(calls)
+    errors = []
+    slots = threading.Semaphore(jobs)
+
+    def run(num, func, args, kwargs):
+        """Make one call and store its result."""
+        try:
+            results[num] = func(*args, **kwargs)
+        except OSError as e:
+            results[num] = e
+        except Exception:  # pylint: disable=broad-except
+            errors.append(sys.exc_info())
+        finally:
+            slots.release()
+
+    threads = []
+    for num, (func, args, kwargs) in enumerate(calls):
+        slots.acquire()
+        thread = threading.Thread(target=run, args=(num, func, args, kwargs))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][1]
+    return results
+
+
+def lint_batch(name, args, temp_files, strip_path=False,
+               output_is_error=False):
+    """Call a Python linter on several files at once.
+
+    Output is split up by the file path each line starts with (or the
+    'File "path"' / '--- path' forms used by tracebacks and diffs, or a path
+    ending the line).
+
+    strip_path:
+        Remove the 'path:' prefix from lines (when args add it only to tell
+        files apart). Lines without the prefix belong to the problem above
+        them (eg pylint's source snippets), up to a blank line or a pylint
+        '*************' header. Other lines are dropped.
+    output_is_error:
+        Assume output means lint failure (rather than non-zero exit) (for yapf)
+
+    Return {temp_file: problem lines}, or None if the linter crashed and each
+    file should be linted separately. Raises OSError if the linter can't be
+    started.
+    """
+    if DEBUG:
+        print('lint_batch', name, args, len(temp_files))
+    problems = dict((temp_file, []) for temp_file in temp_files)
+    p = subprocess.Popen(args + temp_files,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    stdout, _ = p.communicate()
+    if not (p.returncode or (output_is_error and stdout.strip())):
+        return problems
+
+    # Longest first, so a path is never mistaken for a prefix of another
+    by_length = sorted(temp_files, key=len, reverse=True)
+    current = None
+    unattributed = []
+    for line in stdout.splitlines():
+        for temp_file in by_length:
+            if line.startswith(temp_file + ':'):
+                current = temp_file
+                if strip_path:
+                    line = line[len(temp_file) + 1:]
+                break
+            elif line.startswith('--- ' + temp_file) or \
+                    'File "%s"' % temp_file in line or \
+                    line.endswith(' ' + temp_file):
+                current = temp_file
+                break
+        else:
+            if strip_path and (not line.strip() or
+                               line.startswith('*************')):
+                current = None
+        if current:
+            problems[current].append(line)
+        else:
+            unattributed.append(line)
+    if 'Traceback (most recent call last):' in unattributed or \
+            not any(problems.values()):
+        return None
+    return problems
+
+
+def env_flag(name, default):
+    """Return whether the flag in environment variable name is on."""
+    if name not in os.environ:
+        return default
+    return os.environ[name].lower() in ('yes', 'true', '1')
+
+
 def get_config():
-    """Load config from argv & env."""
+    """Load config from env."""
     config = {}
-    config['real_file'] = sys.argv[2]
-    config['temp_file'] = sys.argv[3]
-    config['file_mime'] = sys.argv[4]
-    config['use_python'] = os.environ.get("PENDER_use_python", True)
-    config['use_pylint'] = os.environ.get("PENDER_use_pylint", True)
-    config['use_pep8'] = os.environ.get("PENDER_use_pep8", True)
-    config['use_pep257'] = os.environ.get("PENDER_use_pep257", True)
-    config['use_yapf'] = os.environ.get("PENDER_use_yapf", True)
+    config['use_python'] = env_flag("PENDER_use_python", True)
+    config['use_pylint'] = env_flag("PENDER_use_pylint", True)
+    config['use_pep8'] = env_flag("PENDER_use_pep8", True)
+    config['use_pep257'] = env_flag("PENDER_use_pep257", True)
+    config['use_yapf'] = env_flag("PENDER_use_yapf", True)
     # Max line length -- set to 0 to use each tool's default
     config['max_line_length'] = os.environ.get("PENDER_max_line_length", 0)
     # Ignored linter error codes.
@@ -91,6 +406,18 @@ def get_config():
     else:
         config['pep257_ignored_codes'] = ["D203"]
     config['yapf_style'] = os.environ.get("PENDER_yapf_style", "pep8")
+    config['changed_lines_only'] = env_flag("PENDER_changed_lines_only",
+                                            False)
+    if "PENDER_linter_jobs" in os.environ:
+        config['linter_jobs'] = int(os.environ["PENDER_linter_jobs"])
+    else:
+        # Share the CPUs with the other checks Pender is running
+        try:
+            cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpus = 1
+        config['linter_jobs'] = max(
+            1, cpus // int(os.environ.get("PENDER_JOBS", 1)))
 
     return config
 
@@ -106,70 +433,207 @@ def install():
             print("Couldn't find %s (hint: %s)" % (app, hint))
 
 
-def check():
-    """Run checks."""
-    config = get_config()
+def is_python(real_file, file_mime):
+    """Return True if we should check this file."""
+    return real_file.endswith('.py') or file_mime == 'text/x-python'
 
-    # Check the file is Python
-    if not (config['real_file'].endswith('.py') or
-            config['file_mime'] == 'text/x-python'):
-        return PENDER_OK
 
-    rc = PENDER_OK
+def linters(config, batch=False):
+    """Return the enabled linters as (name, args, options) tuples.
 
+    File paths aren't included in args. In batch mode, output formats are
+    prefixed with the file path, and options are for lint_batch rather than
+    run_lint.
+    """
+    path = '{abspath}:' if batch else ''
     pylint_args = ['pylint', '--reports=no',
-                   '--msg-template={line:3d}: {msg} ({msg_id})']
+                   '--msg-template=%s{line:3d}: {msg} ({msg_id})' % path]
     if config['max_line_length']:
         pylint_args.append('--max-line-length=%s' % config['max_line_length'])
     pylint_args.append('-d=%s' % ','.join(config['pylint_ignored_codes']))
-    pylint_args.append(config['temp_file'])
-    pep8_args = ['pep8', '--format=%(row)3d,%(col)3d: %(text)s (%(code)s)']
+    if batch:
+        # Checks across files would depend on how files are batched
+        pylint_args.append('--disable=duplicate-code,cyclic-import')
+    path = '%(path)s:' if batch else ''
+    pep8_args = ['pep8', '--format=%s%%(row)3d,%%(col)3d: %%(text)s '
+                 '(%%(code)s)' % path]
     if config['max_line_length']:
         pep8_args.append('--max-line-length=%s' % config['max_line_length'])
-    pep8_args.append(config['temp_file'])
     pep257_args = ['pep257']
     pep257_args.append('--ignore=%s' %
                        ','.join(config['pep257_ignored_codes']))
-    pep257_args.append(config['temp_file'])
-
-    linters = (
-        (config['use_python'], {
-            'name': 'python',
-            'args': ('python', '-m', 'py_compile', config['temp_file'])
-        }),
-        (config['use_pylint'], {
-            'name': 'pylint',
-            'args': pylint_args,
-            'strip_first_line': True
-        }),
-        (config['use_pep8'], {
-            'name': 'pep8',
-            'args': pep8_args
-        }),
-        (config['use_pep257'], {
-            'name': 'pep257',
-            'args': pep257_args
-        }),
-        (config['use_yapf'], {
-            'name': 'yapf',
-            'args': ('yapf', '-d', '--style=%s' % config['yapf_style'],
-                     config['temp_file'])
-        }),
+
+    all_linters = (
+        (config['use_python'], 'python', ['python', '-m', 'py_compile'], {}),
+        (config['use_pylint'], 'pylint', pylint_args,
+         {'strip_path': True} if batch else {'strip_first_line': True}),
+        (config['use_pep8'], 'pep8', pep8_args,
+         {'strip_path': True} if batch else {}),
+        (config['use_pep257'], 'pep257', pep257_args, {}),
+        (config['use_yapf'], 'yapf',
+         ['yapf', '-d', '--style=%s' % config['yapf_style']],
+         {'output_is_error': True}),
     )  # yapf:disable
+    return [(name, args, options)
+            for use, name, args, options in all_linters if use]
 
-    for use, kwargs in linters:
-        if use:
-            if not check_lint(**kwargs):
-                rc = PENDER_VETO
+
+def check(real_file, temp_file, file_mime, changed_lines=None):
+    """Run checks.
+
+    changed_lines is [(first, last)] of the lines changed since HEAD, or None
+    if the whole file changed.
+    """
+    config = get_config()
+
+    # Check the file is Python
+    if not is_python(real_file, file_mime):
+        return PENDER_OK
+
+    # Run the linters together, but report in a fixed order
+    source = read_source(temp_file)
+    selected = [(name, yapf_lines(args, changed_lines)
+                 if name == 'yapf' else args, options)
+                for name, args, options in linters(config)]
+    results = run_concurrently(
+        [(lint, (name, args, options, temp_file, source), {})
+         for name, args, options in selected], config['linter_jobs'])
+    rc = PENDER_OK
+    for (name, _, _), result in zip(selected, results):
+        if not isinstance(result, OSError) and not result[0]:
+            lines = filter_problems(name, result[1], temp_file,
+                                    changed_lines, config)
+            result = (not lines, lines)
+        if not print_lint(name, result):
+            rc = PENDER_VETO
 
     return rc
 
 
+def lint_files(batch_linter, single_linter, sources, changed_lines):
+    """Lint several files.
+
+    Linters that can run in-process check each file's source. Others are
+    run once for all files, or once per file if that crashes. yapf is run
+    separately on files with changed lines, as it can only be told them for
+    one file at a time.
+
+    The linters are (name, args, options) from linters(), in batch mode and
+    not. sources is {temp_file: source}, and changed_lines {temp_file:
+    changed lines or None}. Return {temp_file: problem lines}.
+    """
+    name, args, options = batch_linter
+    _, single_args, single_options = single_linter
+    temp_files = sorted(sources)
+    problems = {}
+    if name == 'yapf':
+        separate = [temp_file for temp_file in temp_files
+                    if changed_lines[temp_file] is not None]
+    else:
+        separate = []
+    together = [temp_file for temp_file in temp_files
+                if temp_file not in separate]
+    if together and not in_process(name):
+        batch_problems = lint_batch(name, args, together, **options)
+        if batch_problems is not None:
+            problems.update(batch_problems)
+            together = []
+    for temp_file in together + separate:
+        file_args = single_args
+        if temp_file in separate:
+            file_args = yapf_lines(single_args, changed_lines[temp_file])
+        success, lines = lint(name, file_args, single_options, temp_file,
+                              sources[temp_file])
+        problems[temp_file] = [] if success else lines
+    return problems
+
+
+def check_batch(manifest_path, results_path):
+    """Run checks on every file in a Pender check-batch manifest."""
+    config = get_config()
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    temp_files = [entry['temp_file'] for entry in manifest
+                  if is_python(entry['file'], entry['mime_type'])]
+    changed_lines = dict((entry['temp_file'], entry.get('changed_lines'))
+                         for entry in manifest)
+
+    # {temp_file: output lines}, and the temp files which failed
+    output = dict((temp_file, []) for temp_file in temp_files)
+    failed = set()
+    if temp_files:
+        # Run the linters together, but report in a fixed order
+        selected = zip(linters(config, batch=True), linters(config))
+        sources = dict((temp_file, read_source(temp_file))
+                       for temp_file in temp_files)
+        results = run_concurrently(
+            [(lint_files, (batch_linter, single_linter, sources,
+                           changed_lines), {})
+             for batch_linter, single_linter in selected],
+            config['linter_jobs'])
+        for ((name, _, _), _), problems in zip(selected, results):
+            if isinstance(problems, OSError):
+                for temp_file in temp_files:
+                    output[temp_file].append(
+                        "Couldn't start %s, skipping ('%s')" %
+                        (name, problems))
+                continue
+            for temp_file, lines in problems.iteritems():
+                lines = filter_problems(name, lines, temp_file,
+                                        changed_lines[temp_file], config)
+                if lines:
+                    failed.add(temp_file)
+                    output[temp_file].append("%s problems:" % name)
+                    output[temp_file].extend('    {}'.format(line)
+                                             for line in lines)
+
+    results = {}
+    for entry in manifest:
+        lines = output.get(entry['temp_file'], [])
+        results[entry['file']] = {
+            'returncode':
+            PENDER_VETO if entry['temp_file'] in failed else PENDER_OK,
+            'output': ''.join(line + '\n' for line in lines),
+        }
+    with open(results_path, 'w') as f:
+        json.dump(results, f)
+    return PENDER_OK
+
+
+def serve():
+    """Answer Pender check requests from stdin until it's closed.
+
+    Each request and response is a line of JSON. Anything printed while
+    checking is sent back as the output.
+    """
+    protocol = sys.stdout
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        sys.stdout = StringIO()
+        try:
+            rc = check(request['file'].encode('utf-8'),
+                       request['temp_file'].encode('utf-8'),
+                       request['mime_type'].encode('utf-8'),
+                       request.get('changed_lines'))
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), protocol
+        protocol.write(json.dumps({'returncode': rc, 'output': output}) +
+                       '\n')
+        protocol.flush()
+
+
 def main():
     """Main program."""
     if sys.argv[1] == 'check':
-        rc = check()
+        rc = check(sys.argv[2], sys.argv[3], sys.argv[4],
+                   parse_changed_lines(os.environ.get('PENDER_CHANGED_LINES')))
+        sys.exit(rc)
+    elif sys.argv[1] == 'check-batch':
+        rc = check_batch(sys.argv[2], sys.argv[3])
         sys.exit(rc)
+    elif sys.argv[1] == 'serve':
+        serve()
+        sys.exit()
     elif sys.argv[1] == 'install':
         install()
         sys.exit()
@@ -2,27 +2,187 @@
 """A Pender plugin to check Ruby & ERB file syntax.
 
 There are no configuration options.
+
+Supports Pender's serve action. Files are then compiled by one long-lived
+Ruby process instead of a `ruby -c` run each, with the same output. If that
+process can't start (eg on Rubies without RubyVM), `ruby -c` is used.
+
+pender-actions: serve
+pender-extensions: .rb .erb
+pender-mime-types: text/x-ruby
 """
 
+import os
 import sys
+import json
 import subprocess
 import distutils.spawn
+from StringIO import StringIO
 
 PENDER_OK = 0
 PENDER_VETO = 10
 PENDER_ERR = 1
+DEBUG = 'PENDER_DEBUG' in os.environ
 
+# Compiles files named in JSON requests on stdin, answering each with a line
+# of JSON holding the status and output `ruby -c` would have given
+RUBY_WORKER = r'''
+require 'json'
+require 'erb'
+require 'stringio'
 
-def check_erb():
-    """Check ERB file syntax."""
-    erb_proc = subprocess.Popen(['erb', '-P', '-x', '-T', '-', TEMP_FILE],
+def syntax_check(source, name)
+  warnings = StringIO.new
+  $stderr = warnings
+  begin
+    RubyVM::InstructionSequence.compile(source, name)
+    [0, warnings.string + "Syntax OK\n"]
+  rescue SyntaxError => e
+    message = e.message
+    if name == '-'
+      message += "\n" unless message.end_with?("\n")
+      output = message + "-: compile error (SyntaxError)\n"
+    else
+      first, rest = message.split("\n", 2)
+      output = "#{name}: #{first} (SyntaxError)\n"
+      output << rest << "\n" if rest
+    end
+    [1, warnings.string + output]
+  ensure
+    $stderr = STDERR
+  end
+end
+
+def erb_source(template)
+  ERB.new(template, trim_mode: '-').src
+rescue ArgumentError  # Before Ruby 2.6
+  ERB.new(template, nil, '-').src
+end
+
+RubyVM::InstructionSequence  # Fails now if this Ruby hasn't got it
+$stdout.sync = true
+puts 'ready'
+$stdin.each_line do |line|
+  request = JSON.parse(line)
+  begin
+    source = File.read(request['path'], encoding: 'UTF-8')
+    source = erb_source(source) if request['erb']
+    status, output = syntax_check(source, request['name'])
+    response = {'status' => status,
+                'output' => output.dup.force_encoding('UTF-8').scrub}
+  rescue StandardError, ScriptError => e
+    response = {'error' => e.message.dup.force_encoding('UTF-8').scrub}
+  end
+  puts JSON.generate(response)
+end
+'''
+
+# Whether each tool is installed, as serve checks many files
+FOUND = {}
+
+
+def have(app):
+    """Return True if app is on the PATH."""
+    if app not in FOUND:
+        FOUND[app] = bool(distutils.spawn.find_executable(app))
+    return FOUND[app]
+
+
+class RubyWorker(object):
+    """A Ruby process which syntax checks files like `ruby -c`.
+
+    It's started the first time it's needed. If it can't start, or fails,
+    check() returns None and the caller should run `ruby -c` instead.
+    """
+
+    def __init__(self):
+        """Prepare to start the worker."""
+        self.process = None
+        self.broken = False
+
+    def start(self):
+        """Start the worker. Raises OSError if it doesn't start."""
+        self.process = subprocess.Popen(['ruby', '-e', RUBY_WORKER],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        if self.process.stdout.readline() != 'ready\n':
+            self.close()
+            raise OSError("Ruby worker didn't start")
+
+    def check(self, path, name, erb=False):
+        """Compile path (as ERB if erb), naming it name in messages.
+
+        Return (returncode, output) as `ruby -c` would, or None.
+        """
+        if self.broken:
+            return None
+        try:
+            if self.process is None:
+                self.start()
+            self.process.stdin.write(json.dumps({'path': path,
+                                                 'name': name,
+                                                 'erb': erb}) + '\n')
+            self.process.stdin.flush()
+            response = json.loads(self.process.stdout.readline())
+            if 'error' in response:
+                raise ValueError(response['error'])
+            return (response['status'], response['output'].encode('utf-8'))
+        except (OSError, IOError, ValueError) as err:
+            if DEBUG:
+                sys.stderr.write("Ruby worker failed, using ruby -c (%s)\n" %
+                                 err)
+            self.broken = True
+            self.close()
+            return None
+
+    def close(self):
+        """Stop the worker, if it's running."""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+        self.process = None
+
+
+# The Ruby worker, in serve mode
+WORKER = None
+
+
+def ruby_syntax(temp_file):
+    """Return the (returncode, output) of `ruby -c temp_file`."""
+    if WORKER:
+        result = WORKER.check(temp_file, temp_file)
+        if result is not None:
+            return result
+    try:
+        return 0, subprocess.check_output(['ruby', '-c', temp_file],
+                                          stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as err:
+        return err.returncode, err.output
+
+
+def erb_syntax(temp_file):
+    """Return the output of `erb -P -x -T - temp_file | ruby -c`."""
+    if WORKER:
+        result = WORKER.check(temp_file, '-', erb=True)
+        if result is not None:
+            return result[1]
+    erb_proc = subprocess.Popen(['erb', '-P', '-x', '-T', '-', temp_file],
                                 stdout=subprocess.PIPE)
     ruby_proc = subprocess.Popen(["ruby", "-c"],
                                  stdin=erb_proc.stdout,
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.STDOUT)
     erb_proc.stdout.close()  # XXX: is this right??
-    output = ruby_proc.communicate()[0].strip()
+    return ruby_proc.communicate()[0]
+
+
+def check_erb(temp_file):
+    """Check ERB file syntax."""
+    output = erb_syntax(temp_file).strip()
     if output == 'Syntax OK':
         return PENDER_OK
     else:
@@ -31,48 +191,74 @@ def check_erb():
         return PENDER_VETO
 
 
-def check_ruby():
+def check_ruby(temp_file):
     """Check Ruby file syntax."""
-    try:
-        subprocess.check_output(['ruby', '-c', TEMP_FILE],
-                                stderr=subprocess.STDOUT)
+    returncode, output = ruby_syntax(temp_file)
+    if not returncode:
         return PENDER_OK
-    except subprocess.CalledProcessError as err:
-        print "Ruby syntax check failed:"
-        for line in err.output.splitlines():
-            print '    {}'.format(line)
-        return PENDER_VETO
+    print "Ruby syntax check failed:"
+    for line in output.splitlines():
+        print '    {}'.format(line)
+    return PENDER_VETO
+
+
+def check(real_file, temp_file, file_mime):
+    """Check a file, and return the Pender exit code."""
+    # See if we should run
+    if not (real_file.endswith('.rb') or real_file.endswith('.erb') or
+            file_mime == 'text/x-ruby'):
+        return PENDER_OK
+    if not have('ruby'):
+        print "ruby not installed, skipping check."
+        return PENDER_ERR
+    if real_file.endswith('.rb'):
+        return check_ruby(temp_file)
+    else:  # .erb
+        if not have('erb'):
+            print "erb not installed, skipping check."
+            return PENDER_ERR
+        return check_erb(temp_file)
+
+
+def serve():
+    """Answer Pender check requests from stdin until it's closed.
+
+    Each request and response is a line of JSON. Anything printed while
+    checking is sent back as the output.
+    """
+    global WORKER  # pylint: disable=global-statement
+    WORKER = RubyWorker()
+    protocol = sys.stdout
+    try:
+        for line in iter(sys.stdin.readline, ''):
+            request = json.loads(line)
+            sys.stdout = StringIO()
+            try:
+                rc = check(request['file'].encode('utf-8'),
+                           request['temp_file'].encode('utf-8'),
+                           request['mime_type'].encode('utf-8'))
+            finally:
+                output, sys.stdout = sys.stdout.getvalue(), protocol
+            protocol.write(json.dumps({'returncode': rc, 'output': output}) +
+                           '\n')
+            protocol.flush()
+    finally:
+        WORKER.close()
 
 
 if __name__ == '__main__':
     if sys.argv[1] == 'check':
-        pass
+        sys.exit(check(sys.argv[2], sys.argv[3], sys.argv[4]))
+    elif sys.argv[1] == 'serve':
+        serve()
+        sys.exit(PENDER_OK)
     elif sys.argv[1] == 'install':
         for app, hint in (('ruby', 'https://www.ruby-lang.org/en/downloads/'),
                           ('erb', 'https://www.ruby-lang.org/en/downloads/'),
                           ):
-            if not distutils.spawn.find_executable(app):
+            if not have(app):
                 print "Couldn't find %s (hint: %s)" % (app, hint)
         sys.exit(0)
     else:
         print "Unknown action %s" % sys.argv[1]
         sys.exit(PENDER_ERR)
-
-    REAL_FILE = sys.argv[2]
-    TEMP_FILE = sys.argv[3]
-    FILE_MIME = sys.argv[4]
-
-    # See if we should run
-    if not (REAL_FILE.endswith('.rb') or REAL_FILE.endswith('.erb') or
-            FILE_MIME == 'text/x-ruby'):
-        sys.exit(PENDER_OK)
-    if not distutils.spawn.find_executable('ruby'):
-        print "ruby not installed, skipping check."
-        sys.exit(1)
-    if REAL_FILE.endswith('.rb'):
-        sys.exit(check_ruby())
-    else:  # .erb
-        if not distutils.spawn.find_executable('erb'):
-            print "erb not installed, skipping check."
-            sys.exit(1)
-        sys.exit(check_erb())
@@ -3,6 +3,9 @@
 # A Pender plugin to lint shell scripts. Uses bash & shellcheck.
 # Configuration:
 #   skip_shellcheck: if set to anything, don't try to use shellcheck.
+#
+# pender-extensions: .sh
+# pender-mime-types: text/x-shellscript
 
 # Exit codes
 PENDER_OK=0
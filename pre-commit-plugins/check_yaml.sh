@@ -2,6 +2,9 @@
 
 # A Pender plugin to check YAML files. Uses python-yaml.
 # There are no configuration options.
+#
+# pender-extensions: .yaml
+# pender-inputs: stdin
 
 case $1 in
     install)
@@ -33,7 +36,11 @@ if ! python -c 'import yaml' 2>/dev/null ; then
     exit $PENDER_OK
 fi
 
-python -c "import yaml; yaml.load(open('$TEMP_FILE'))" 2>&1 | awk '/^yaml/ {p=1} p;'
+# Named after the real file, as the content may come from /dev/stdin
+python -c 'import io, sys, yaml
+stream = io.BytesIO(open(sys.argv[2], "rb").read())
+stream.name = sys.argv[1]
+yaml.load(stream)' "$REAL_FILE" "$TEMP_FILE" 2>&1 | awk '/^yaml/ {p=1} p;'
 syntax_rc=${PIPESTATUS[0]}
 
 if [[ $syntax_rc != 0 ]] ; then
@@ -4,14 +4,34 @@ Pender pre-commit hook.
 
 For more information see https://github.com/alexjurkiewicz/pender
 """
+# The hook is installed by copying this one file into .git/hooks
+# pylint: disable=too-many-lines
 
 import os
+import re
 import sys
+import json
+import time
+import errno
+import marshal
+import fcntl
+import struct
+import termios
+import select
+import hashlib
+import argparse
+import resource
+import contextlib
+import collections
 import shutil
+import signal
 import subprocess
 import tempfile
+import fnmatch
 import logging
-import yaml
+import itertools
+import threading
+import Queue
 
 if 'GIT_DIR' in os.environ:
     PENDER_NAME = os.path.basename(sys.argv[0]) + '.py'
@@ -28,6 +48,65 @@ PENDER_EXIT_ERR = 1
 PENDER_EXIT_VETO = 10
 GIT_EXIT_OK = 0
 GIT_EXIT_VETO = 1
+UNKNOWN_MIME_TYPE = 'application/octet-stream'
+EMPTY_MIME_TYPE = 'inode/x-empty'
+# Extensions we trust without sniffing. Only formats `file` reports the same
+# way across versions belong here.
+EXTENSION_MIME_TYPES = {
+    '.gif': 'image/gif',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+}
+# Files bigger than this are only given to plugins which ask for large files,
+# unless max_file_size_kb is set
+MAX_FILE_SIZE = 10 * 2**20  # bytes
+CONFIG_CACHE_NAME = 'config'
+MIME_CACHE_NAME = 'mime-types'
+MIME_CACHE_MAX_ENTRIES = 20000
+RESULT_CACHE_NAME = 'results'
+RESULT_CACHE_PRUNE_INTERVAL = 3600  # seconds
+# Plugin environment variables which don't affect verdicts
+RESULT_CACHE_IGNORED_ENV = ('PENDER_JOBS', 'PENDER_TRACE')
+# Stands in for the temp file path in saved output, which changes every run
+RESULT_CACHE_TEMP_MARKER = '\0PENDER_TEMP_FILE\0'
+# Plugins declare optional features in 'pender-<key>: <values>' lines near
+# the top of the file
+PLUGIN_HEADER_LINES = 40
+PLUGIN_HEADER_RE = re.compile(r'^\W*pender-([a-z-]+):\s*(.*?)\s*$',
+                              re.IGNORECASE)
+# Output kept from each plugin run, unless max_output_kb is set
+PLUGIN_OUTPUT_LIMIT = 2**20  # bytes
+# Files passed between pipeline stages at a time, and how many such chunks
+# may wait between two stages
+PIPELINE_CHUNK_SIZE = 256
+PIPELINE_QUEUE_CHUNKS = 4
+# With adaptive_jobs, how often load and memory are sampled, and the memory
+# left free for everything else when starting another check
+THROTTLE_SAMPLE_INTERVAL = 0.5  # seconds
+MIN_FREE_MEMORY = 256 * 2**20  # bytes
+# Resource limits plugin_settings can set: key, resource, units in the key
+PLUGIN_LIMITS = (('max_memory_mb', resource.RLIMIT_AS, 2**20),
+                 ('max_cpu_seconds', resource.RLIMIT_CPU, 1))
+# The background daemon's files in the cache directory, and the log size at
+# which it starts afresh
+DAEMON_PID_NAME = 'daemon.pid'
+DAEMON_LOG_NAME = 'daemon.log'
+DAEMON_LOG_MAX_SIZE = 2**20  # bytes
+# Added to the daemon's niceness, so it doesn't slow down interactive work
+DAEMON_NICENESS = 10
+# The daemon checks the index once it's been left alone this long, and polls
+# it this often where inotify isn't available
+DAEMON_SETTLE_TIME = 0.2  # seconds
+DAEMON_POLL_INTERVAL = 1  # seconds
+# inotify events meaning a file was written or renamed into place
+INOTIFY_CLOSE_WRITE = 0x8
+INOTIFY_MOVED_TO = 0x80
+# The temp file path given to plugins reading content from stdin
+STDIN_PATH = '/dev/stdin'
+# '@@ -old[,count] +new[,count] @@' in `git diff -U0` output
+DIFF_HUNK_RE = re.compile(r'^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
 
 
 def check_output(*popenargs, **kwargs):
@@ -61,6 +140,1128 @@ class PenderError(Exception):
     pass
 
 
+class PluginTimeout(Exception):
+    """A plugin run was killed for taking too long."""
+
+    def __init__(self, output, reason):
+        """Describe the run, with its output so far and why it was killed."""
+        super(PluginTimeout, self).__init__(reason)
+        self.output = output
+        self.reason = reason
+
+
+class Cancelled(Exception):
+    """Checks were stopped early, so a plugin's result isn't wanted."""
+
+
+class StagedFile(object):
+    # pylint: disable=too-many-instance-attributes
+    """A changed file and what we know about its staged content.
+
+    The content is only written to temp_file (under the hook's temp tree, at
+    the file's repository path) once a plugin needs it there.
+    """
+
+    def __init__(self, path, temp_file=None, blob=(None, None, None),
+                 commit=None):
+        """Describe path, staged as blob, a (SHA-1, size, error) tuple.
+
+        The error is set if the content couldn't be read. commit is set when
+        checking the file as of a pushed commit.
+        """
+        self.path = path
+        self.commit = commit
+        self.temp_file = temp_file
+        self.blob_sha, self.size, self.error = blob
+        self.written = False  # Whether temp_file exists yet
+        self.content = None  # For plugins reading it from stdin
+        self.mime_type = UNKNOWN_MIME_TYPE
+        self.binary = False
+        self.large = False  # Over max_file_size_kb, so content isn't read
+        # [(first, last)] staged line ranges changed since HEAD, or None for
+        # the whole file
+        self.changed_lines = None
+
+    def discard(self):
+        """Forget the content, and delete the temp file, once checked."""
+        self.content = None
+        if self.written:
+            try:
+                os.unlink(self.temp_file)
+            except OSError:
+                pass
+            self.written = False
+
+    def describe(self):
+        """Return the path, and the commit it's from if there is one."""
+        if self.commit is None:
+            return self.path
+        return '%s in %s' % (self.path, self.commit[:12])
+
+
+class Selection(object):
+    """Which files to check, and which version of them.
+
+    By default, the files added or modified in the index compared to HEAD,
+    as staged. With all_files, every tracked file as staged (eg in a CI
+    checkout). With rev_range, 'A..B' (or 'A...B' to diff from their merge
+    base), the files added or modified between two commits, as of B. A bare
+    'A' means 'A..HEAD'. With push, `git log` arguments from parse_push(),
+    the files added or modified by each commit being pushed, as of that
+    commit. shard is (i, N) to keep only the i'th (from 1) of N slices of
+    the files, split by a hash of their paths so every machine agrees.
+    """
+
+    def __init__(self, all_files=False, rev_range=None, shard=None,
+                 push=None):
+        """Resolve the revisions in rev_range."""
+        self.all_files = all_files
+        self.shard = shard
+        self.push = push
+        self.base = self.revision = None
+        if rev_range is not None:
+            if '...' in rev_range:
+                base, revision = rev_range.split('...', 1)
+                self.revision = resolve_commit(revision or 'HEAD')
+                self.base = merge_base(resolve_commit(base or 'HEAD'),
+                                       self.revision)
+            else:
+                base, _, revision = rev_range.partition('..')
+                self.base = resolve_commit(base or 'HEAD')
+                self.revision = resolve_commit(revision or 'HEAD')
+
+    @property
+    def mode(self):
+        """Name the selection for reports: staged, all-files, range or push."""
+        if self.push is not None:
+            return 'push'
+        if self.revision is not None:
+            return 'range'
+        return 'all-files' if self.all_files else 'staged'
+
+    def files(self):
+        """Yield the files to check in this shard, as listed.
+
+        Each is (path, commit, blob SHA-1). The commit and blob are None
+        unless checking pushed commits, when git lists them with the path.
+        """
+        if self.push is not None:
+            files = pushed_files(self.push)
+        else:
+            if self.revision is not None:
+                paths = changed_files(self.base, self.revision)
+            elif self.all_files:
+                paths = tracked_files()
+            else:
+                paths = changed_files()
+            files = ((path, None, None) for path in paths)
+        for path, commit, blob_sha in files:
+            if self.shard and int(hashlib.sha1(path).hexdigest(), 16) % \
+                    self.shard[1] != self.shard[0] - 1:
+                continue
+            yield path, commit, blob_sha
+
+    def changed_lines(self):
+        """Return the changed lines of each file (see changed_line_ranges()).
+
+        With all_files or push, every file is checked whole, so this is
+        empty.
+        """
+        if self.all_files or self.push is not None:
+            return {}
+        return changed_line_ranges(self.base, self.revision)
+
+
+class Plugin(object):
+    # pylint: disable=too-many-instance-attributes
+    """A plugin executable and its settings for this run.
+
+    Which files a plugin applies to comes from its header's extensions,
+    mime-types and paths (globs) keys. The same keys in the plugin's
+    plugin_settings entry override the header. A plugin with none of these
+    is run on every file.
+
+    plugin_settings can also set a timeout, resource limits (see
+    PLUGIN_LIMITS), and whether the plugin is exclusive (see Throttle).
+    """
+
+    def __init__(self, path, plugin_config, plugin_settings=None):
+        """Load the plugin at path, configured from plugin_config."""
+        self.path = path
+        self.name = os.path.basename(path)
+        self.env = plugin_env(path, plugin_config)
+        self.header = plugin_header(path)
+        self.actions = set(self.header.get('actions', ()))
+        self.inputs = set(self.header.get('inputs', ()))
+        # Only the check action can read content from stdin
+        self.stdin = 'stdin' in self.inputs and \
+            not self.actions & set(('check-batch', 'serve'))
+        self.digest = ResultCache.plugin_digest(path, self.env)
+        settings = (plugin_settings or {}).get(
+            os.path.splitext(self.name)[0]) or {}
+        self.timeout = settings.get('timeout')
+        if self.timeout is not None:
+            try:
+                self.timeout = float(self.timeout)
+            except (TypeError, ValueError):
+                raise PenderError("Invalid timeout for %s: %r" %
+                                  (self.name, self.timeout))
+        self.exclusive = bool(settings.get('exclusive', False))
+        self.limits = []  # (resource, limit) for the plugin's processes
+        for key, limit, units in PLUGIN_LIMITS:
+            value = settings.get(key)
+            if value is None:
+                continue
+            if not isinstance(value, (int, long)) or value <= 0:
+                raise PenderError("Invalid %s for %s: %r" % (key, self.name,
+                                                             value))
+            self.limits.append((limit, value * units))
+        self.extensions = plugin_filter('extensions', settings, self.header)
+        self.mime_types = plugin_filter('mime_types', settings, self.header)
+        self.paths = plugin_filter('paths', settings, self.header)
+
+    @property
+    def filtered(self):
+        """True if the plugin only applies to some files."""
+        return bool(self.extensions or self.mime_types or self.paths)
+
+    def skips(self, staged_file):
+        """Return why the plugin won't check staged_file, or None if it will.
+
+        Large and binary files are only checked by plugins declaring the
+        large-files and binary-files inputs.
+        """
+        if staged_file.large and 'large-files' not in self.inputs:
+            return 'large'
+        if staged_file.binary and 'binary-files' not in self.inputs:
+            return 'binary'
+        return None
+
+    def changed_lines(self, staged_file):
+        """Return the changed lines of staged_file to tell the plugin.
+
+        None if the plugin doesn't use them, or the whole file changed.
+        """
+        if 'changed-lines' in self.inputs:
+            return staged_file.changed_lines
+        return None
+
+    def temp_file(self, staged_file):
+        """Return the path the plugin reads staged_file's content from."""
+        return STDIN_PATH if self.stdin else staged_file.temp_file
+
+    def cache_key(self, staged_file):
+        """Return the ResultCache key for the plugin checking staged_file."""
+        return ResultCache.key(staged_file, self.digest,
+                               self.changed_lines(staged_file))
+
+    def request(self, staged_file):
+        """Describe staged_file for a check-batch manifest or serve request."""
+        request = {
+            'file': staged_file.path,
+            'temp_file': staged_file.temp_file,
+            'mime_type': staged_file.mime_type,
+        }
+        if 'changed-lines' in self.inputs:
+            request['changed_lines'] = staged_file.changed_lines
+        return request
+
+    def file_env(self, staged_file):
+        """Return the environment to check staged_file with."""
+        changed_lines = self.changed_lines(staged_file)
+        if changed_lines is None and 'PENDER_CHANGED_LINES' not in self.env:
+            return self.env
+        env = dict(self.env)
+        env.pop('PENDER_CHANGED_LINES', None)
+        if changed_lines is not None:
+            env['PENDER_CHANGED_LINES'] = ','.join(
+                '%d-%d' % line_range for line_range in changed_lines)
+        return env
+
+
+class PluginIndex(object):
+    """Finds the plugins applying to a file without running them."""
+
+    def __init__(self, plugin_list):
+        """Index plugin_list by their declared filters."""
+        self.plugins = plugin_list
+        self.everything = []
+        self.by_extension = {}
+        self.patterns = []  # (plugin number, mime patterns, path patterns)
+        self.by_mime_type = any(plugin.mime_types for plugin in plugin_list)
+        for plugin_num, plugin in enumerate(plugin_list):
+            if not plugin.filtered:
+                self.everything.append(plugin_num)
+                continue
+            for extension in plugin.extensions:
+                self.by_extension.setdefault(extension, []).append(plugin_num)
+            if plugin.mime_types or plugin.paths:
+                self.patterns.append((plugin_num, plugin.mime_types,
+                                      plugin.paths))
+
+    def may_check(self, path):
+        """Return whether any plugin might check the file at path.
+
+        Until its MIME type is known, a file might be checked by any plugin
+        filtered by MIME type.
+        """
+        if self.everything or self.by_mime_type or \
+                os.path.splitext(path)[1] in self.by_extension:
+            return True
+        return any(fnmatch.fnmatchcase(path, pattern)
+                   for _, _, paths in self.patterns for pattern in paths)
+
+    def plugins_for(self, staged_file):
+        """Return the sorted plugin numbers which apply to staged_file."""
+        matches = set(self.everything)
+        extension = os.path.splitext(staged_file.path)[1]
+        matches.update(self.by_extension.get(extension, ()))
+        for plugin_num, mime_types, paths in self.patterns:
+            if plugin_num in matches:
+                continue
+            if any(fnmatch.fnmatchcase(staged_file.mime_type, pattern)
+                   for pattern in mime_types) or \
+                    any(fnmatch.fnmatchcase(staged_file.path, pattern)
+                        for pattern in paths):
+                matches.add(plugin_num)
+        return sorted(matches)
+
+
+class PluginServer(object):
+    """Long-lived `serve` processes of a plugin, reused for every check.
+
+    A worker is started for each concurrent check, and kept until close().
+    A worker which dies is replaced once. If that fails too, checks fall
+    back to running the plugin once per file.
+    """
+
+    def __init__(self, plugin):
+        """Prepare to serve checks by plugin."""
+        self.plugin = plugin
+        self.idle = []  # (process, stderr file)
+        self.lock = threading.Lock()
+        self.broken = False
+
+    def start_worker(self):
+        """Start a worker process. Return (process, stderr file)."""
+        args = (self.plugin.path, 'serve')
+        logging.debug("Starting %s", args)
+        # stderr goes to a file so it can't block the worker or mix with
+        # the protocol, and is shown if the worker dies.
+        stderr = tempfile.TemporaryFile()
+        try:
+            # A CPU limit would count every file the worker checks
+            return (PROCESSES.start(args,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=stderr,
+                                    env=self.plugin.env,
+                                    limits=[
+                                        (limit, value) for limit, value in
+                                        self.plugin.limits
+                                        if limit != resource.RLIMIT_CPU]),
+                    stderr)
+        except OSError:
+            stderr.close()
+            raise
+
+    def stop_worker(self, worker, reason=None):
+        """Stop a worker, logging its stderr if it stopped for a reason."""
+        process, stderr = worker
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        # Workers exit once stdin closes, but don't wait long for them
+        for _ in range(20):
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+        else:
+            PROCESSES.kill(process)
+            process.wait()
+        PROCESSES.finished(process)
+        if reason:
+            stderr.seek(0)
+            logging.warning("%s worker %s %s (exit code %s). stderr:\n%s",
+                            self.plugin.name, process.pid, reason,
+                            process.returncode, stderr.read())
+        stderr.close()
+
+    def request(self, worker, staged_file):
+        """Send a check request to worker.
+
+        Return (returncode, output), or None if the worker didn't answer.
+        """
+        process = worker[0]
+        try:
+            process.stdin.write(
+                json.dumps(self.plugin.request(staged_file)) + '\n')
+            process.stdin.flush()
+            response = json.loads(process.stdout.readline())
+            return (int(response['returncode']),
+                    response.get('output', '').encode('utf-8'))
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def check(self, staged_file, timeout=(None, None)):
+        """Check staged_file with a worker. Return (returncode, output).
+
+        Raises PluginTimeout if the worker doesn't answer within timeout
+        (see run_plugin()), after stopping it.
+        """
+        start = time.time()
+        for _ in range(2):
+            if self.broken:
+                break
+            with self.lock:
+                worker = self.idle.pop() if self.idle else None
+            if worker is None:
+                try:
+                    worker = self.start_worker()
+                except OSError as err:
+                    logging.warning("Couldn't start %s worker (%s).",
+                                    self.plugin.name, err)
+                    self.broken = True
+                    break
+            watchdog = Watchdog(worker[0], timeout[0])
+            result = self.request(worker, staged_file)
+            if PROCESSES.stopped:
+                raise Cancelled()
+            if watchdog.stop():
+                self.stop_worker(worker)
+                raise PluginTimeout('', timeout[1])
+            if result is not None:
+                TRACER.add('%s serve' % self.plugin.name, start,
+                           time.time() - start, file=staged_file.path,
+                           worker=worker[0].pid, returncode=result[0])
+                with self.lock:
+                    self.idle.append(worker)
+                if result[0] not in (PENDER_EXIT_OK, PENDER_EXIT_VETO):
+                    logging.warning("%s returned unexpected exit code %s for "
+                                    "%s, skipping.", self.plugin.name,
+                                    result[0], staged_file.path)
+                return result
+            self.stop_worker(worker, "died checking %s" % staged_file.path)
+        else:
+            self.broken = True
+        logging.debug("Running %s once per file instead of as a worker.",
+                      self.plugin.name)
+        return plugin_check(self.plugin, staged_file, timeout)
+
+    def close(self):
+        """Stop all workers."""
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            self.stop_worker(worker)
+
+
+class ResultCache(object):
+    """Plugin verdicts saved under the git directory.
+
+    Entries are keyed on the staged blob, its path, the plugin's contents and
+    the plugin's PENDER_* environment, so changing any of them is a miss. For
+    plugins told which lines changed, those are part of the key too.
+    Only OK and veto verdicts are saved; plugin errors (eg a missing linter)
+    are retried every time.
+    """
+
+    def __init__(self, path):
+        """Use the cache directory at path."""
+        self.path = path
+
+    @staticmethod
+    def plugin_digest(plugin, env):
+        """Return a digest of plugin's contents and configuration."""
+        digest = hashlib.sha1()
+        with open(plugin, 'rb') as f:
+            digest.update(f.read())
+        for key in sorted(env):
+            if key.startswith('PENDER_') and \
+                    key not in RESULT_CACHE_IGNORED_ENV:
+                digest.update('\0%s=%s' % (key, env[key]))
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(staged_file, plugin_digest, changed_lines=None):
+        """Return the cache key for a plugin (by digest) checking a file."""
+        fields = [staged_file.blob_sha, staged_file.path, plugin_digest]
+        if changed_lines is not None:
+            fields.append(repr(changed_lines))
+        return hashlib.sha1('\0'.join(fields)).hexdigest()
+
+    def _entry_path(self, key):
+        """Return the file storing key."""
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key, temp_file):
+        """Return the saved (returncode, output) for key, or None.
+
+        References to the temp file in output are updated to temp_file.
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                returncode, output = f.read().split('\n', 1)
+            os.utime(path, None)  # Keep recently used entries from pruning
+            return (int(returncode),
+                    output.replace(RESULT_CACHE_TEMP_MARKER, temp_file))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, temp_file, returncode, output):
+        """Save the returncode and output of a plugin run on temp_file."""
+        if returncode not in (PENDER_EXIT_OK, PENDER_EXIT_VETO):
+            return
+        path = self._entry_path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), mode=0o700)
+            # Write then rename, so concurrent hooks never see half an entry
+            temp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write('%d\n%s' % (returncode, output.replace(
+                    temp_file, RESULT_CACHE_TEMP_MARKER)))
+            os.rename(temp_path, path)
+        except (IOError, OSError) as err:
+            logging.debug("Couldn't save result cache entry %s (%s)", path,
+                          err)
+
+    def prune(self, max_age, max_size):
+        """Delete old entries, then least recently used ones to fit max_size.
+
+        Entries unused for max_age seconds are removed, then more until the
+        cache is under max_size bytes. This is only done every
+        RESULT_CACHE_PRUNE_INTERVAL seconds.
+        """
+        if not os.path.isdir(self.path):
+            return  # Nothing saved yet
+        stamp = os.path.join(self.path, 'last-pruned')
+        now = time.time()
+        try:
+            if now - os.stat(stamp).st_mtime < RESULT_CACHE_PRUNE_INTERVAL:
+                return
+        except OSError:
+            pass
+        entries = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path == stamp:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > max_age:
+                    self._remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            self._remove(path)
+            total -= size
+        with open(stamp, 'w'):
+            pass
+
+    @staticmethod
+    def _remove(path):
+        """Remove a cache entry, ignoring races with other hooks."""
+        try:
+            os.unlink(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def clear(self):
+        """Delete every entry."""
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+
+class PluginProcesses(object):
+    """The plugin processes running now.
+
+    Each is started in its own process group, so it can be killed along with
+    anything it started. That also keeps them from seeing Ctrl-C, so main()
+    stops them instead.
+    """
+
+    def __init__(self):
+        """Start with no processes."""
+        self.running = set()
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def start(self, args, limits=(), **kwargs):
+        """Start a process like subprocess.Popen, and track it.
+
+        limits are (resource, limit) pairs to set as the process's soft
+        limits (up to its hard limits). Raises Cancelled once stop() has been
+        called.
+        """
+        def prepare():
+            """Set up the child process before it runs the plugin."""
+            os.setpgrp()
+            for limit, value in limits:
+                _, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.setrlimit(limit, (value, hard))
+
+        with self.lock:
+            if self.stopped:
+                raise Cancelled()
+            process = subprocess.Popen(args, preexec_fn=prepare, **kwargs)
+            self.running.add(process)
+        return process
+
+    def finished(self, process):
+        """Stop tracking process, which has been reaped."""
+        with self.lock:
+            self.running.discard(process)
+
+    @staticmethod
+    def kill(process):
+        """Kill process's group, if it's still around."""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError as err:
+            if err.errno not in (errno.ESRCH, errno.EPERM):
+                raise
+
+    def stop(self):
+        """Kill every running process's group, and start no more."""
+        with self.lock:
+            self.stopped = True
+            processes = list(self.running)
+        for process in processes:
+            self.kill(process)
+
+
+# Plugin processes of this run, killed on timeout, interrupt or fail_fast
+PROCESSES = PluginProcesses()
+
+
+class Watchdog(object):
+    """Kills a plugin process if it runs longer than timeout seconds."""
+
+    def __init__(self, process, timeout):
+        """Start timing process. A timeout of None never fires."""
+        self.process = process
+        self.fired = False
+        self.lock = threading.Lock()
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(max(timeout, 0), self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        """Kill the process, unless the watchdog was stopped."""
+        with self.lock:
+            if self.timer is None:
+                return
+            self.fired = True
+            PROCESSES.kill(self.process)
+
+    def stop(self):
+        """Stop timing the process. Return True if it was killed."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        return self.fired
+
+
+class TimeBudget(object):
+    """Time limits for plugin runs.
+
+    Each run may take its plugin's timeout (plugin_timeout unless
+    overridden in plugin_settings), but no run goes past commit_timeout
+    seconds from when the budget was created. Both may be None for no limit.
+    Checks that were cut off are remembered for the summary.
+    """
+
+    def __init__(self, plugin_timeout=None, commit_timeout=None):
+        """Start the clock."""
+        self.plugin_timeout = plugin_timeout
+        self.deadline = None
+        if commit_timeout is not None:
+            self.deadline = time.time() + commit_timeout
+        self.cut_off = []  # (plugin name, [file paths], reason)
+        self.lock = threading.Lock()
+
+    def timeout(self, plugin, files=1):
+        """Return (seconds, reason) a run of plugin on files may take.
+
+        Batch runs get the plugin's timeout for each file. seconds is None
+        if there's no limit, and 0 or less once commit_timeout has passed.
+        """
+        timeout = plugin.timeout if plugin.timeout is not None \
+            else self.plugin_timeout
+        if timeout is not None:
+            timeout = float(timeout) * files
+            reason = "timeout of %gs" % timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if timeout is None or remaining < timeout:
+                return remaining, "commit_timeout reached"
+        if timeout is None:
+            return None, None
+        return timeout, reason
+
+    def record(self, plugin, staged_files, reason):
+        """Remember that plugin's checks of staged_files were cut off."""
+        paths = [staged_file.path for staged_file in staged_files]
+        with self.lock:
+            self.cut_off.append((plugin.name, paths, reason))
+
+    def summary(self):
+        """Log the checks that were cut off."""
+        if not self.cut_off:
+            return
+        logging.warning("Checks cut off by time limits (%s, counted as "
+                        "plugin errors):", sum(len(paths) for _, paths, _ in
+                                               self.cut_off))
+        for name, paths, reason in sorted(self.cut_off):
+            logging.warning("    %s on %s (%s)", name, ", ".join(paths),
+                            reason)
+
+
+class Throttle(object):
+    # pylint: disable=too-many-instance-attributes
+    """Holds plugin checks back while the machine is busy.
+
+    Up to jobs checks run at once (see run_parallel()). If adaptive, another
+    check only starts while there's a CPU to spare, judged from the load
+    average and how many processes are runnable now (including our own
+    checks), and enough memory is available for the largest plugin process
+    so far with MIN_FREE_MEMORY to spare (on Linux). So checks waiting on
+    I/O still run jobs at once, while checks busy on the CPU, or other work
+    on the machine, hold more back. Checks by exclusive plugins never run at
+    the same time as each other. One check can always run.
+    """
+
+    def __init__(self, adaptive=False):
+        """Start with no checks running."""
+        self.adaptive = adaptive
+        self.cond = threading.Condition()
+        self.running = 0
+        self.exclusive = False  # Whether an exclusive plugin's running
+        self.cpus = None
+        self.load = 0.0  # CPUs in use
+        self.free = None  # Bytes of memory available
+        self.sampled = 0
+
+    def sample(self):
+        """Update the load and free memory, if they're out of date."""
+        now = time.time()
+        if now - self.sampled < THROTTLE_SAMPLE_INTERVAL:
+            return
+        self.sampled = now
+        if self.cpus is None:
+            import multiprocessing  # Only needed here, and slow to import
+            try:
+                self.cpus = multiprocessing.cpu_count()
+            except NotImplementedError:
+                self.cpus = 1
+        # The load average lags, so still counts checks that have finished;
+        # the runnable count is current, but jumpy. Only what they both say
+        # holds checks back.
+        loads = [value for value in cpu_load() if value is not None]
+        self.load = min(loads) if loads else 0.0
+        self.free = available_memory()
+
+    def blocker(self, plugin):
+        """Return why plugin can't start a check yet, or None if it can."""
+        if plugin.exclusive and self.exclusive:
+            return "an exclusive plugin is running"
+        if not self.running or not self.adaptive:
+            return None
+        self.sample()
+        if self.load >= self.cpus:
+            return "load %.1f on %s CPUs" % (self.load, self.cpus)
+        if self.free is not None:
+            # Our biggest process yet is the best guess at this one's size
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            needed = usage if sys.platform == 'darwin' else usage * 1024
+            for limit, value in plugin.limits:
+                if limit == resource.RLIMIT_AS:
+                    needed = min(needed, value)
+            if self.free - needed < MIN_FREE_MEMORY:
+                return "%s MB of memory free" % (self.free // 2**20)
+        return None
+
+    def start(self, plugin):
+        """Wait until plugin can start a check, then count it as running."""
+        with self.cond:
+            reason = self.blocker(plugin)
+            if reason:
+                logging.debug("Holding %s back (%s).", plugin.name, reason)
+                start = time.time()
+                while reason and not PROCESSES.stopped:
+                    # Check again when another check finishes, or the load
+                    # and memory are next sampled
+                    self.cond.wait(THROTTLE_SAMPLE_INTERVAL)
+                    reason = self.blocker(plugin)
+                TRACER.add('throttled', start, time.time() - start,
+                           plugin=plugin.name)
+            self.running += 1
+            if plugin.exclusive:
+                self.exclusive = True
+
+    def finish(self, plugin):
+        """Note that a check by plugin has finished."""
+        with self.cond:
+            self.running -= 1
+            if plugin.exclusive:
+                self.exclusive = False
+            self.sampled = 0  # The load has changed
+            self.cond.notify_all()
+
+
+def cpu_load():
+    """Return (1 minute load average, processes runnable now).
+
+    Either is None if unknown. The runnable count is only known on Linux,
+    and doesn't include this process.
+    """
+    try:
+        with open('/proc/loadavg', 'r') as f:
+            # eg '0.52 0.58 0.59 2/345 12345'
+            fields = f.read().split()
+        return float(fields[0]), int(fields[3].split('/')[0]) - 1
+    except (IOError, IndexError, ValueError):
+        pass
+    try:
+        return os.getloadavg()[0], None
+    except (AttributeError, OSError):
+        return None, None
+
+
+def available_memory():
+    """Return the bytes of memory available without swapping, or None.
+
+    Only known on Linux.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, IndexError, ValueError):
+        pass
+    return None
+
+
+class Tracer(object):
+    """Records how long each part of the hook takes.
+
+    Events are saved in Chrome's trace event format (load them in
+    chrome://tracing or https://ui.perfetto.dev). Each has the wall time,
+    and where known the CPU time and peak RSS of the child processes. On
+    Linux a child's peak RSS is at least Pender's own RSS when it forked.
+    """
+
+    def __init__(self):
+        """Start the clock."""
+        self.events = []
+        self.threads = {}  # Small numbers for thread ids, easier to read
+        self.lock = threading.Lock()
+
+    def add(self, name, start, duration, usage=None, **args):
+        """Record an event which took duration seconds from start.
+
+        usage is the resource usage of the child processes involved.
+        """
+        if usage:
+            args['child_cpu_s'] = round(usage.ru_utime + usage.ru_stime, 6)
+            # Linux reports kilobytes, OSX bytes
+            args['child_max_rss_kb'] = usage.ru_maxrss // 1024 \
+                if sys.platform == 'darwin' else usage.ru_maxrss
+        with self.lock:
+            thread_num = self.threads.setdefault(
+                threading.current_thread().ident, len(self.threads))
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int(duration * 1e6),
+                'pid': os.getpid(),
+                'tid': thread_num,
+                'args': args,
+            })
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        """Record the enclosed code as an event.
+
+        Child process usage is the change in RUSAGE_CHILDREN, so is only
+        accurate if no other thread is running processes meanwhile. The peak
+        RSS is the largest of any child so far.
+        """
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield args
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            # pylint: disable=no-member
+            usage = after.__class__(
+                [after[i] - before[i] for i in range(2)] + list(after[2:]))
+            self.add(name, start, time.time() - start, usage, **args)
+
+    def save(self, path):
+        """Write the events to path as JSON."""
+        try:
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': self.events,
+                           'displayTimeUnit': 'ms'}, f)
+        except IOError as err:
+            logging.warning("Couldn't write trace to %s (%s)", path, err)
+        else:
+            logging.info("Wrote trace to %s", path)
+
+
+# Timings of this run, saved if PENDER_TRACE or the trace config key is set
+TRACER = Tracer()
+
+
+class Stage(object):
+    """One stage of a pipeline, calling func on each of items in a thread.
+
+    At most PIPELINE_QUEUE_CHUNKS results wait to be taken, so the stage
+    only gets that far ahead of the next one. Iterating over the stage
+    yields the results in order, and re-raises any exception from func or
+    items. The stage's run is traced as name, with the count of what's in
+    the items (which are lists).
+
+    If not threaded, func is called on each item as the stage is iterated
+    over instead, which is quicker when there's only one item.
+    """
+
+    _done = object()  # Queued after the last result
+
+    def __init__(self, name, func, items, threaded=True):
+        """Start the stage's thread, if threaded."""
+        self.name = name
+        self.func = func
+        self.items = items
+        self.queue = Queue.Queue(PIPELINE_QUEUE_CHUNKS)
+        self.stopped = threading.Event()
+        if threaded:
+            thread = threading.Thread(target=self.run,
+                                      args=(name, func, items))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.queue = None
+
+    def run(self, name, func, items):
+        """Queue func's result for each item, until stopped."""
+        try:
+            with TRACER.phase(name, count=0) as trace_args:
+                for item in items:
+                    if self.stopped.is_set():
+                        return
+                    trace_args['count'] += len(item)
+                    self.queue.put((func(item), None))
+        except Exception as err:  # pylint: disable=broad-except
+            self.queue.put((None, err))
+        else:
+            self.queue.put(self._done)
+
+    def __iter__(self):
+        """Yield each result as it's ready."""
+        if self.queue is None:
+            for item in self.items:
+                with TRACER.phase(self.name, count=len(item)):
+                    result = self.func(item)
+                yield result
+            return
+        # Python 2 can't interrupt a blocking get(), so the main thread
+        # polls. Other threads block, as Python 2 waits with a timeout by
+        # sleeping and waking repeatedly.
+        poll = threading.current_thread().name == 'MainThread'
+        while True:
+            try:
+                entry = self.queue.get(True, 0.1) if poll \
+                    else self.queue.get()
+            except Queue.Empty:
+                continue
+            if entry is self._done:
+                return
+            result, err = entry
+            if err is not None:
+                raise err
+            yield result
+
+    def stop(self):
+        """Stop the thread after its current item, eg after a veto."""
+        self.stopped.set()
+        if self.queue is None:
+            return
+        # Make room in case it's waiting to queue a result
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+def chunked(items, size):
+    """Yield lists of up to size items from the iterable items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class PluginOutput(object):
+    """The output of a plugin run, up to limit bytes.
+
+    Output past the limit is dropped, and counted. If prefix is set, each
+    line is also logged as it arrives, after the prefix.
+    """
+
+    def __init__(self, limit=PLUGIN_OUTPUT_LIMIT, prefix=None):
+        """Start with no output."""
+        self.limit = limit
+        self.prefix = prefix
+        self.lines = []
+        self.size = 0
+        self.dropped = 0
+
+    def add(self, line):
+        """Add a line (or part of a very long one) of output."""
+        if self.dropped or self.size + len(line) > self.limit:
+            if not self.dropped and self.prefix is not None:
+                logging.info("%s: [output truncated]", self.prefix)
+            self.dropped += len(line)
+            return
+        self.lines.append(line)
+        self.size += len(line)
+        if self.prefix is not None:
+            logging.info("%s: %s", self.prefix, line.rstrip('\n'))
+
+    def value(self):
+        """Return the output, with a note if any was dropped."""
+        output = ''.join(self.lines)
+        if self.dropped:
+            if output and not output.endswith('\n'):
+                output += '\n'
+            output += "[%s more bytes of output truncated]\n" % self.dropped
+        return output
+
+
+def stream_lines(output, limit, prefix):
+    """Log a finished check's output a line at a time, like PluginOutput."""
+    streamed = PluginOutput(limit, prefix)
+    for line in output.splitlines(True):
+        streamed.add(line)
+
+
+class Progress(object):
+    # pylint: disable=too-many-instance-attributes
+    """A status line showing how far the checks have got.
+
+    It's only drawn when stdout is a terminal. Log messages are printed above
+    it by PenderLoggingHandler.
+    """
+
+    def __init__(self):
+        """Start hidden."""
+        self.enabled = False
+        self.lock = threading.RLock()
+        self.total = 0
+        self.done = 0
+        self.running = {}  # plugin name: count
+        self.width = 80
+        self.shown = False
+        self.last_draw = 0
+
+    def start(self, total=0, done=0):
+        """Show progress through total files, of which done are finished."""
+        with self.lock:
+            self.enabled = sys.stdout.isatty()
+            if not self.enabled:
+                return
+            try:
+                # Some terminals (eg under `script`) report no width
+                self.width = struct.unpack('hh', fcntl.ioctl(
+                    sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))[1] \
+                    or self.width
+            except (IOError, struct.error):
+                pass
+            self.total = total
+            self.done = done
+            self.draw(True)
+
+    def stop(self):
+        """Remove the status line for good."""
+        with self.lock:
+            self.clear()
+            self.enabled = False
+
+    def set_done(self, done, total):
+        """Update how many files are finished, of how many found so far."""
+        with self.lock:
+            self.done = done
+            self.total = total
+            self.draw()
+
+    def plugin_started(self, name):
+        """Note a plugin run starting."""
+        with self.lock:
+            self.running[name] = self.running.get(name, 0) + 1
+            self.draw()
+
+    def plugin_finished(self, name):
+        """Note a plugin run finishing."""
+        with self.lock:
+            self.running[name] -= 1
+            if not self.running[name]:
+                del self.running[name]
+            self.draw()
+
+    def clear(self):
+        """Erase the status line, if it's shown."""
+        with self.lock:
+            if self.shown:
+                sys.stdout.write('\r\033[K')
+                sys.stdout.flush()
+                self.shown = False
+
+    def draw(self, force=False):
+        """Draw the status line, at most ten times a second unless forced."""
+        with self.lock:
+            now = time.time()
+            if not self.enabled or (not force and now - self.last_draw < 0.1):
+                return
+            self.last_draw = now
+            running = ', '.join(
+                name if count == 1 else '%s x%s' % (name, count)
+                for name, count in sorted(self.running.iteritems()))
+            line = "%s: checked %s/%s files%s" % (
+                PENDER_NAME, self.done, self.total,
+                '; running ' + running if running else '')
+            sys.stdout.write('\r%s\033[K' % line[:self.width - 1])
+            sys.stdout.flush()
+            self.shown = True
+
+
+# Status line for this run
+PROGRESS = Progress()
+
+
 class PenderLoggingFormatter(logging.Formatter):
     """Custom log formatter.
 
@@ -94,25 +1295,223 @@ class PenderLoggingFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
+class PenderLoggingHandler(logging.StreamHandler):
+    """Writes log messages to stdout, above the progress line."""
+
+    def emit(self, record):
+        """Write record, then redraw the progress line."""
+        with PROGRESS.lock:
+            PROGRESS.clear()
+            logging.StreamHandler.emit(self, record)
+            PROGRESS.draw(True)
+
+
 def load_config():
-    """Load pre-commit.yaml."""
+    """Load pre-commit.yaml.
+
+    When run as a hook, the parsed config is cached in the git directory
+    (see load_config_cache()), so most runs don't need PyYAML at all.
+    """
     if 'GIT_DIR' in os.environ:
         path = os.path.join(os.environ['GIT_DIR'], '..', CONFIG_NAME)
+        cache_path = os.path.join(cache_dir(), CONFIG_CACHE_NAME)
     else:
         path = CONFIG_NAME
-    if os.path.isfile(path):
+        cache_path = None
+    if not os.path.isfile(path):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise PenderError("Couldn't load config: %s" % e)
+    stamp = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    cached = load_config_cache(cache_path)
+    if cached and cached[0] == stamp:
+        return cached[2]
+    try:
+        with open(path, 'rb') as f:
+            text = f.read()
+    except IOError as e:
+        raise PenderError("Couldn't load config: %s" % e)
+    digest = hashlib.sha1(text).hexdigest()
+    if cached and cached[1] == digest:
+        data = cached[2]  # Touched, or checked out again, but the same
+    else:
+        data = parse_config(text)
+    save_config_cache(cache_path, (stamp, digest, data))
+    return data
+
+
+def parse_config(text):
+    """Parse and check the text of pre-commit.yaml."""
+    # Imported here as it's slow, and usually the cached config is used
+    import yaml
+    try:
+        data = yaml.load(text)
+    except yaml.YAMLError as e:
+        raise PenderError("Couldn't load config: %s" % e)
+    if not isinstance(data, dict):
+        raise PenderError("Config toplevel isn't a mapping (dict).")
+    # Load stubs if any sections are missing
+    for section in ('pender', 'plugins'):
+        if section not in data:
+            data[section] = {}
+    return data
+
+
+def load_config_cache(cache_path):
+    """Return the saved (stamp, digest, config), or None.
+
+    stamp is the config file's (path, mtime, size), and digest the SHA-1 of
+    its contents, when it was parsed.
+    """
+    if cache_path is None:
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = marshal.load(f)
+        stamp, digest, data = cached
+        return (tuple(stamp), digest, data)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+
+def save_config_cache(cache_path, cached):
+    """Save (stamp, digest, config) for load_config_cache()."""
+    if cache_path is None:
+        return
+    # Write then rename, so concurrent hooks never see half a file
+    temp_path = '%s.%s.tmp' % (cache_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            marshal.dump(cached, f)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError, ValueError) as err:
+        # ValueError: YAML types marshal can't save, eg dates
+        logging.debug("Couldn't save config cache %s (%s)", cache_path, err)
         try:
-            with open(path, 'r') as f:
-                data = yaml.load(f)
-        except (OSError, yaml.parser.ParserError) as e:
-            raise PenderError("Couldn't load config: %s" % e)
-        if not isinstance(data, dict):
-            raise PenderError("Config toplevel isn't a mapping (dict).")
-        # Load stubs if any sections are missing
-        for section in ('pender', 'plugins'):
-            if section not in data:
-                data[section] = {}
-        return data
+            os.unlink(temp_path)
+        except OSError:
+            pass
+
+
+def job_count(pender_config):
+    """Return how many checks to run at once.
+
+    PENDER_JOBS in the environment overrides the `jobs` config key. Defaults
+    to the number of CPUs.
+    """
+    jobs = os.environ.get('PENDER_JOBS', pender_config.get('jobs'))
+    if jobs is None or jobs == 'auto':
+        import multiprocessing  # Only needed here, and slow to import
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        raise PenderError("Invalid jobs setting: %r" % jobs)
+    if jobs < 1:
+        raise PenderError("jobs must be at least 1 (got %s)." % jobs)
+    return jobs
+
+
+def result_cache(pender_config):
+    """Return the ResultCache, or None if it's disabled by the config."""
+    if not pender_config.get('cache', True):
+        return None
+    return ResultCache(os.path.join(cache_dir(), RESULT_CACHE_NAME))
+
+
+def cache_limits(pender_config):
+    """Return the result cache's (max age, max size) in seconds and bytes."""
+    return (positive_setting(pender_config, 'cache_max_age_days', 30) * 86400,
+            positive_setting(pender_config, 'cache_max_size_mb', 50) * 2**20)
+
+
+def positive_setting(pender_config, key, default=None):
+    """Return the config's key as a positive float, or default if unset."""
+    value = pender_config.get(key, default)
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise PenderError("Invalid %s setting: %r" % (key, value))
+    if number <= 0:
+        raise PenderError("%s must be positive (got %s)." % (key, value))
+    return number
+
+
+def time_budget(pender_config):
+    """Return the TimeBudget set by the config."""
+    return TimeBudget(positive_setting(pender_config, 'plugin_timeout'),
+                      positive_setting(pender_config, 'commit_timeout'))
+
+
+def throttle_for(pender_config):
+    """Return the Throttle set by the config's adaptive_jobs key."""
+    adaptive = pender_config.get('adaptive_jobs', True)
+    if not isinstance(adaptive, bool):
+        raise PenderError("Invalid adaptive_jobs setting: %r" % adaptive)
+    return Throttle(adaptive)
+
+
+def daemon_idle_time(pender_config):
+    """Return the seconds the daemon waits for a change before stopping."""
+    minutes = pender_config.get('daemon_idle_minutes', 60)
+    try:
+        minutes = float(minutes)
+    except (TypeError, ValueError):
+        raise PenderError("Invalid daemon_idle_minutes setting: %r" % minutes)
+    if minutes <= 0:
+        raise PenderError("daemon_idle_minutes must be positive (got %s)." %
+                          minutes)
+    return minutes * 60
+
+
+def output_limit(pender_config):
+    """Return how many bytes of output to keep from each plugin run."""
+    limit = pender_config.get('max_output_kb')
+    if limit is None:
+        return PLUGIN_OUTPUT_LIMIT
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise PenderError("Invalid max_output_kb setting: %r" % limit)
+    if limit < 1:
+        raise PenderError("max_output_kb must be at least 1 (got %s)." %
+                          limit)
+    return limit * 1024
+
+
+def max_file_size(pender_config):
+    """Return the size in bytes over which files count as large."""
+    limit = pender_config.get('max_file_size_kb')
+    if limit is None:
+        return MAX_FILE_SIZE
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise PenderError("Invalid max_file_size_kb setting: %r" % limit)
+    if limit < 1:
+        raise PenderError("max_file_size_kb must be at least 1 (got %s)." %
+                          limit)
+    return limit * 1024
+
+
+def clear_caches():
+    """Delete all cached check results, MIME types and config."""
+    ResultCache(os.path.join(cache_dir(), RESULT_CACHE_NAME)).clear()
+    for name in (MIME_CACHE_NAME, CONFIG_CACHE_NAME):
+        try:
+            os.unlink(os.path.join(cache_dir(), name))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise PenderError("Couldn't clear %s cache (%s)" %
+                                  (name, err))
+    logging.info("Cleared cache in %s", cache_dir())
 
 
 def initialise_logging():
@@ -122,7 +1521,7 @@ def initialise_logging():
     else:
         level = logging.INFO
     fmt = PenderLoggingFormatter()
-    hdlr = logging.StreamHandler(sys.stdout)
+    hdlr = PenderLoggingHandler(sys.stdout)
     hdlr.setFormatter(fmt)
     logging.root.addHandler(hdlr)
     logging.root.setLevel(level)
@@ -152,9 +1551,9 @@ def install_check(plugin_dir):
 
 def autoupdate_check():
     """See if the repo version of Pender is newer, and fail if so."""
-    git_dir = os.path.join(os.environ['GIT_DIR'])
-    pender_repo_path = os.path.join(git_dir, '..', PENDER_NAME)
-    pender_hook_path = os.path.join(git_dir, 'hooks', 'pre-commit')
+    git_path = os.path.join(os.environ['GIT_DIR'])
+    pender_repo_path = os.path.join(git_path, '..', PENDER_NAME)
+    pender_hook_path = os.path.join(git_path, 'hooks', 'pre-commit')
     logging.debug("Comparing %s to %s", pender_repo_path, pender_hook_path)
     if os.stat(pender_repo_path).st_mtime > os.stat(pender_hook_path).st_mtime:
         logging.error("%s has been updated, please run the repository's "
@@ -168,46 +1567,410 @@ def install_plugins(plugin_dir):
         plugin_install(plugin)
 
 
-def changed_files():
-    """Iterable of changed files."""
-    changed_files_cmd = ['git', 'diff-index', '--diff-filter=AM',
-                         '--name-only', '--cached', 'HEAD']
+def git_records(git_args, description):
+    """Yield the NUL-terminated records a git command prints, as it runs.
+
+    Raises PenderError, described as description, if git fails.
+    """
+    # stderr goes to a file so a chatty git can't block on a full pipe
+    errors = tempfile.TemporaryFile()
     try:
-        files = subprocess.check_output(changed_files_cmd).splitlines()
-    except subprocess.CalledProcessError as err:
-        raise PenderError(
-            "Couldn't determine changed files! Git error was:\n$ %s\n%s",
-            ' '.join(changed_files_cmd), err.output)
-    logging.debug("%s changed files: %s", len(files), ", ".join(files))
-    return files
+        git = subprocess.Popen(git_args, stdout=subprocess.PIPE,
+                               stderr=errors)
+    except OSError as e:
+        errors.close()
+        raise PenderError("Couldn't %s (%s)" % (description, e))
+    partial = ''
+    try:
+        for data in iter(lambda: git.stdout.read(65536), ''):
+            records = (partial + data).split('\0')
+            partial = records.pop()
+            for record in records:
+                yield record
+        git.stdout.close()
+        if git.wait() or partial:
+            errors.seek(0)
+            raise PenderError("Couldn't %s! Git error was:\n$ %s\n%s" %
+                              (description, ' '.join(git_args),
+                               errors.read()))
+    finally:
+        # Also when our caller stops early
+        if git.returncode is None:
+            git.stdout.close()
+            git.wait()
+        errors.close()
 
 
-def create_temp_file(temp_tree, index_file):
-    """Copy staged changes of index_file to same location in temp_tree."""
-    git_args = ['git', 'cat-file', 'blob', ':0:{}'.format(index_file)]
-    repo_path = os.path.dirname(index_file).lstrip('/')
-    temp_dirpath = os.path.join(temp_tree, repo_path)
+def changed_files(base=None, revision=None):
+    """Iterable of changed files, yielded as git lists them.
 
-    if repo_path and not os.path.isdir(temp_dirpath):
-        os.makedirs(temp_dirpath, mode=0o700)
+    These are the staged changes, or if given the changes from commit base to
+    commit revision.
+    """
+    if revision is None:
+        changed_files_cmd = ['git', 'diff-index', '--diff-filter=AM',
+                             '--name-only', '-z', '--cached', 'HEAD']
+    else:
+        changed_files_cmd = ['git', 'diff-tree', '-r', '--diff-filter=AM',
+                             '--name-only', '-z', base, revision]
+    count = 0
+    for path in git_records(changed_files_cmd, "determine changed files"):
+        count += 1
+        yield path
+    logging.debug("%s changed files", count)
+
+
+def tracked_files():
+    """Iterable of every file in the index, except submodules."""
+    ls_files_cmd = ['git', 'ls-files', '--stage', '-z']
+    count = 0
+    for entry in git_records(ls_files_cmd, "list tracked files"):
+        # '<mode> <blob sha> <stage>\t<path>'
+        info, _, path = entry.partition('\t')
+        mode, _, stage = info.split(' ')
+        if mode != '160000' and stage == '0':
+            count += 1
+            yield path
+    logging.debug("%s tracked files", count)
+
+
+def parse_push(lines, remote=None):
+    """Return `git log` arguments selecting the commits being pushed.
+
+    lines are what git gives a pre-push hook on stdin: '<local ref> <local
+    SHA-1> <remote ref> <remote SHA-1>' for each ref pushed. Commits the
+    remote has already, and those on its remote-tracking branches (on any
+    remote's if remote isn't given), are left out. Return None if only
+    deleting refs.
+    """
+    pushed = []
+    known = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 4:
+            raise PenderError("Unexpected pre-push input %r" %
+                              line.rstrip('\n'))
+        local, remote_sha = fields[1], fields[3]
+        if local.strip('0'):  # Not deleting the ref
+            pushed.append(local)
+        # The remote's tip may be a commit we haven't fetched
+        if remote_sha.strip('0') and rev_parse(remote_sha + '^{commit}'):
+            known.append(remote_sha)
+    if not pushed:
+        return None
+    return pushed + ['--not'] + known + \
+        ['--remotes=%s' % remote if remote else '--remotes']
+
+
+def pushed_files(log_args):
+    """Yield (path, commit, blob SHA-1) for each file the commits change.
+
+    log_args select the commits (see parse_push()), which are listed oldest
+    first, each with the files it adds or modifies. Merges only list files
+    that differ from every parent, eg resolved conflicts. Submodules are
+    skipped.
+    """
+    log_cmd = ['git', 'log', '--reverse', '--topo-order', '-z', '--raw',
+               '-c', '--no-renames', '--no-abbrev', '--diff-filter=AM',
+               '--format=%H'] + log_args
+    records = git_records(log_cmd, "list pushed files")
+    commit = None
+    count = 0
+    for record in records:
+        # Commits are listed before their files, with newlines between
+        record = record.lstrip('\n')
+        if not record.startswith(':'):
+            commit = record or commit
+            continue
+        # ':<modes> <blobs> <status>', then the path. Merges list a mode and
+        # blob per parent, then the new ones.
+        path = next(records)
+        fields = record.lstrip(':').split()
+        if fields[len(fields) // 2 - 1] != '160000':
+            count += 1
+            yield path, commit, fields[-2]
+    logging.debug("%s pushed files", count)
+
+
+def resolve_commit(name):
+    """Return the SHA-1 of the commit name refers to."""
+    commit = rev_parse(name + '^{commit}')
+    if not commit:
+        raise PenderError("Unknown commit %r" % name)
+    return commit
+
+
+def merge_base(base, revision):
+    """Return the best common ancestor of two commits."""
+    merge_base_cmd = ['git', 'merge-base', base, revision]
+    try:
+        return subprocess.check_output(merge_base_cmd).strip()
+    except (subprocess.CalledProcessError, OSError):
+        raise PenderError("No merge base of %s and %s" % (base, revision))
+
+
+def changed_line_ranges(base=None, revision=None):
+    """Return the staged lines changed since HEAD in each modified file.
+
+    If revision is given, the lines changed from commit base to it instead.
+    The result is {path: [(first, last)]}, numbered in the new content.
+    Lines either side of removed lines count as changed. New files and files
+    without text changes are left out.
+    """
+    diff_cmd = ['git', 'diff-index', '--cached', '--diff-filter=M', '-p',
+                '-U0', '--no-color', '--no-ext-diff', '--src-prefix=a/',
+                '--dst-prefix=b/', 'HEAD']
+    if revision is not None:
+        diff_cmd[1:3] = ['diff-tree', '-r']
+        diff_cmd[-1:] = [base, revision]
+    try:
+        diff = subprocess.Popen(diff_cmd, stdout=subprocess.PIPE)
+    except OSError as e:
+        raise PenderError("Couldn't start %s (%s)" % (' '.join(diff_cmd), e))
+    ranges = {}
+    path = None
+    skip = 0  # Content lines left in the current hunk
+    for line in diff.stdout:
+        if line.startswith('\\'):  # '\ No newline at end of file'
+            continue
+        elif skip:
+            skip -= 1
+        elif line.startswith('+++ '):
+            path = diff_path(line)
+            ranges[path] = []
+        elif path is not None and line.startswith('@@ '):
+            hunk = hunk_range(line)
+            if not hunk:
+                continue
+            line_range, skip = hunk
+            if ranges[path] and ranges[path][-1][1] >= line_range[0] - 1:
+                ranges[path][-1] = (ranges[path][-1][0], line_range[1])
+            else:
+                ranges[path].append(line_range)
+    diff.stdout.close()
+    if diff.wait():
+        raise PenderError("Couldn't determine changed lines, %s exited with "
+                          "%s" % (' '.join(diff_cmd), diff.returncode))
+    return dict((path, path_ranges)
+                for path, path_ranges in ranges.iteritems() if path_ranges)
+
+
+def diff_path(line):
+    """Return the path in a diff's '+++ b/path' line."""
+    # Names with spaces end in a tab, unusual ones are C-quoted
+    path = line[4:].rstrip('\n').rstrip('\t')
+    if path.startswith('"'):
+        path = path[1:-1].decode('string_escape')
+    return path[2:]
+
+
+def hunk_range(line):
+    """Return (changed lines, content line count) of a diff hunk header.
+
+    The changed lines are (first, last), numbered in the new content. None
+    if line isn't a hunk header.
+    """
+    match = DIFF_HUNK_RE.match(line)
+    if not match:
+        return None
+    removed, first, added = match.groups()
+    first = int(first)
+    added = 1 if added is None else int(added)
+    if added:
+        line_range = (first, first + added - 1)
+    else:
+        line_range = (max(first, 1), first + 1)
+    return line_range, (1 if removed is None else int(removed)) + added
+
+
+def staged_blobs(index_files, revision=None):
+    """Look up the staged blob of each of index_files.
+
+    Return a list of (blob_sha, size, error) in input order (see
+    blob_info()). If revision is given, the blobs are looked up in that
+    commit instead of the index.
+    """
+    prefix = ':0' if revision is None else revision
+    names = ['%s:%s' % (prefix, index_file) for index_file in index_files]
+    for i, name in enumerate(names):
+        # --batch-check reads a name per line, so resolve these first
+        if '\n' in name:
+            names[i] = rev_parse(name) or '0' * 40
+    return blob_info(names, index_files)
+
+
+def blob_info(names, index_files):
+    """Look up the blobs git object names refer to, for index_files.
+
+    Return a list of (blob_sha, size, error) in input order, from one `git
+    cat-file --batch-check` run. error is a PenderError if the name isn't a
+    blob (and blob_sha and size are None).
+    """
+    git_args = ['git', 'cat-file', '--batch-check']
+    try:
+        git = subprocess.Popen(git_args,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+        output, stderr = git.communicate(''.join(name + '\n'
+                                                 for name in names))
+    except OSError as e:
+        raise PenderError("Couldn't start %s (%s)" % (' '.join(git_args), e))
+    headers = output.splitlines()
+    if git.returncode or len(headers) != len(index_files):
+        raise PenderError("Couldn't look up staged files, git exited with "
+                          "%s:\n%s" % (git.returncode, stderr))
+    blobs = []
+    for index_file, header in zip(index_files, headers):
+        fields = header.split()
+        if len(fields) != 3 or fields[1] != 'blob':
+            blobs.append((None, None, PenderError(
+                "Couldn't read staged content of %s (%s)" % (index_file,
+                                                             header))))
+        else:
+            blobs.append((fields[0], int(fields[2]), None))
+    return blobs
+
+
+def rev_parse(name):
+    """Return the SHA-1 of the object name refers to, or None."""
+    rev_parse_cmd = ['git', 'rev-parse', '--verify', '--quiet', name]
+    try:
+        return subprocess.check_output(rev_parse_cmd).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def read_blobs(wanted):
+    """Fetch the staged content of files with one `git cat-file --batch` run.
+
+    wanted is a list of (staged_file, write_temp_file, keep_content). The
+    content is written to staged_file.temp_file, kept in memory as
+    staged_file.content, or both. If it can't be read, staged_file.error is
+    set instead. Content already in memory (eg sniffed for its MIME type) is
+    written from there rather than read again.
+    """
+    for staged_file, write_temp_file, _ in wanted:
+        if write_temp_file and staged_file.content is not None:
+            with open_temp_file(staged_file) as dest:
+                dest.write(staged_file.content)
+            staged_file.written = True
+            logging.debug("Created temp file %s", staged_file.temp_file)
+    wanted = [(staged_file, write_temp_file, keep_content)
+              for staged_file, write_temp_file, keep_content in wanted
+              if staged_file.content is None]
+    if not wanted:
+        return
+    reader = BlobReader()
+    try:
+        for staged_file, write_temp_file, keep_content in wanted:
+            reader.read(staged_file, write_temp_file, keep_content)
+    finally:
+        reader.close()
+
+
+class BlobReader(object):
+    """A `git cat-file --batch` run, reading staged blobs one at a time."""
 
-    # We can't use check_output here, since we want to capture stderr
-    # for error diagnostics but check_output can only do so by merging into
-    # stdout (which we're using).
-    temp_file = os.path.join(temp_dirpath, os.path.basename(index_file))
-    with open(temp_file, 'w') as dest:
+    def __init__(self):
+        """Start git."""
+        git_args = ['git', 'cat-file', '--batch']
+        # stderr goes to a file so a chatty git can't block on a full pipe
+        self.errors = tempfile.TemporaryFile()
         try:
-            git = subprocess.Popen(git_args,
-                                   stdout=dest,
-                                   stderr=subprocess.PIPE)
+            self.git = subprocess.Popen(git_args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=self.errors)
         except OSError as e:
-            raise PenderError("Couldn't create temp file for %s (%s)" %
-                              (index_file, e))
-        _, stderr = git.communicate()
-        if git.returncode:
-            raise PenderError(stderr)
-    logging.debug("Created temp file %s", temp_file)
-    return temp_file
+            self.errors.close()
+            raise PenderError("Couldn't start %s (%s)" %
+                              (' '.join(git_args), e))
+
+    def failed(self):
+        """Build an exception describing why git stopped responding."""
+        self.git.wait()
+        self.errors.seek(0)
+        return PenderError("Couldn't read staged files, git exited with %s:"
+                           "\n%s" % (self.git.returncode, self.errors.read()))
+
+    def read(self, staged_file, write_temp_file, keep_content):
+        """Fetch staged_file's content (see read_blobs())."""
+        git = self.git
+        # cat-file flushes its output after each object, so we can send one
+        # request at a time without risking a pipe deadlock.
+        try:
+            git.stdin.write(staged_file.blob_sha + '\n')
+            git.stdin.flush()
+        except IOError:
+            raise self.failed()
+        header = git.stdout.readline()
+        if not header:
+            raise self.failed()
+        fields = header.split()
+        if len(fields) != 3 or fields[1] != 'blob':
+            staged_file.error = PenderError(
+                "Couldn't read staged content of %s (%s)" %
+                (staged_file.path, header.strip()))
+            return
+        size = int(fields[2])
+
+        dest = open_temp_file(staged_file) if write_temp_file else None
+        chunks = []
+        try:
+            while size:
+                chunk = git.stdout.read(min(size, 65536))
+                if not chunk:
+                    raise self.failed()
+                if dest:
+                    dest.write(chunk)
+                if keep_content:
+                    chunks.append(chunk)
+                size -= len(chunk)
+        finally:
+            if dest:
+                dest.close()
+        git.stdout.read(1)  # Trailing newline after the content
+        if write_temp_file:
+            staged_file.written = True
+            logging.debug("Created temp file %s", staged_file.temp_file)
+        if keep_content:
+            staged_file.content = ''.join(chunks)
+
+    def close(self):
+        """Stop git, if it's still running."""
+        if self.git.returncode is None:
+            self.git.stdin.close()
+            self.git.stdout.close()
+            self.git.wait()
+        self.errors.close()
+
+
+def open_temp_file(staged_file):
+    """Create staged_file's temp file, and its directory, for writing."""
+    temp_dirpath = os.path.dirname(staged_file.temp_file)
+    if not os.path.isdir(temp_dirpath):
+        os.makedirs(temp_dirpath, mode=0o700)
+    return open(staged_file.temp_file, 'wb')
+
+
+def git_dir():
+    """Return the path of the repository's git directory."""
+    if 'GIT_DIR' in os.environ:
+        return os.environ['GIT_DIR']
+    git_args = ['git', 'rev-parse', '--git-dir']
+    try:
+        return subprocess.check_output(git_args).strip()
+    except (subprocess.CalledProcessError, OSError) as err:
+        raise PenderError("Couldn't find git directory (%s)" % err)
+
+
+def cache_dir():
+    """Return Pender's cache directory inside the git directory."""
+    path = os.path.join(git_dir(), 'pender')
+    if not os.path.isdir(path):
+        os.makedirs(path, mode=0o700)
+    return path
 
 
 def plugins(plugin_dir):
@@ -223,15 +1986,248 @@ def plugins(plugin_dir):
         yield plugin
 
 
-def get_mime_type(path):
-    """Return mime type of f (application/octet-stream if unknown)."""
+def plugin_header(path):
+    """Return the {key: [values]} a plugin declares in its header.
+
+    Values are separated by commas or whitespace.
+    """
+    header = {}
     try:
-        file_args = ['file', '--brief', '--mime-type', path]
-        mime_type = subprocess.check_output(file_args).strip()
-    except (subprocess.CalledProcessError, OSError) as err:
-        logging.info("Couldn't determine MIME type of %s (\"%s\").", path, err)
-        mime_type = 'application/octet-stream'
-    return mime_type
+        with open(path, 'r') as f:
+            for _, line in zip(range(PLUGIN_HEADER_LINES), f):
+                match = PLUGIN_HEADER_RE.match(line)
+                if match:
+                    header.setdefault(match.group(1).lower(), []).extend(
+                        value for value in re.split(r'[\s,]+',
+                                                    match.group(2)) if value)
+    except IOError as err:
+        logging.warning("Couldn't read plugin %s (%s)", path, err)
+    return header
+
+
+def plugin_filter(key, settings, header):
+    """Return a plugin's key filter values, from its settings or header."""
+    values = settings.get(key, header.get(key.replace('_', '-'), []))
+    if isinstance(values, str):
+        values = values.split(',')
+    return list(values)
+
+
+class MimeSniffer(object):
+    """Detects the MIME type of content, as `file --brief --mime` would.
+
+    libmagic (which `file` uses) is loaded with ctypes to do this
+    in-process, the first time it's needed. If it can't be, `file` is run
+    for each content, reading it from stdin.
+    """
+
+    MAGIC_MIME = 0x410  # MAGIC_MIME_TYPE | MAGIC_MIME_ENCODING
+
+    def __init__(self):
+        """Prepare to load libmagic."""
+        self.magic = None  # (library, cookie), once loaded
+        self.loaded = False
+        self.lock = threading.Lock()  # A cookie can't be shared by threads
+
+    def in_process(self):
+        """Return True if libmagic is loaded, loading it if need be."""
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                self.magic = self._load()
+        return self.magic is not None
+
+    @staticmethod
+    def _load():
+        """Return libmagic and a cookie ready to sniff with, or None."""
+        # Imported here as it's only needed when content is sniffed
+        import ctypes
+        import ctypes.util
+        name = ctypes.util.find_library('magic')
+        if not name:
+            logging.debug("libmagic not found, running file instead.")
+            return None
+        try:
+            lib = ctypes.CDLL(name)
+            lib.magic_open.restype = ctypes.c_void_p
+            lib.magic_open.argtypes = [ctypes.c_int]
+            lib.magic_load.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+            lib.magic_descriptor.restype = ctypes.c_char_p
+            lib.magic_descriptor.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            lib.magic_error.restype = ctypes.c_char_p
+            lib.magic_error.argtypes = [ctypes.c_void_p]
+        except (OSError, AttributeError) as err:
+            logging.debug("Couldn't load libmagic (%s), running file "
+                          "instead.", err)
+            return None
+        cookie = lib.magic_open(MimeSniffer.MAGIC_MIME)
+        if not cookie:
+            return None
+        if lib.magic_load(cookie, None) != 0:
+            logging.debug("libmagic couldn't load its database (%s), "
+                          "running file instead.", lib.magic_error(cookie))
+            return None
+        return lib, cookie
+
+    def sniff(self, content):
+        """Return the (mime_type, binary) of content.
+
+        Raises OSError if it can't be sniffed, eg `file` isn't installed.
+        """
+        if not content:
+            # Not worth sniffing, and named as `file` names empty files
+            return EMPTY_MIME_TYPE, False
+        if self.in_process():
+            # Through a pipe, like `file -`: some checks (eg for ELF
+            # executables) only run on descriptors, not buffers
+            lib, cookie = self.magic
+            read_fd, write_fd = os.pipe()
+            writer = write_pipe(os.fdopen(write_fd, 'wb'), content)
+            try:
+                with self.lock:
+                    output = lib.magic_descriptor(cookie, read_fd)
+                    if output is None:
+                        raise OSError(lib.magic_error(cookie))
+            finally:
+                os.close(read_fd)
+                writer.join()
+        else:
+            proc = subprocess.Popen(['file', '--brief', '--mime', '-'],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, stderr = proc.communicate(content)
+            if proc.returncode or not output.strip():
+                raise OSError(stderr.strip() or
+                              'file exited %s' % proc.returncode)
+        # eg 'text/plain; charset=us-ascii'
+        mime_type, _, params = output.strip().partition(';')
+        return mime_type, 'charset=binary' in params
+
+
+MIME_SNIFFER = MimeSniffer()
+
+
+class MimeCache(object):
+    """The {blob_sha: (mime_type, binary)} of blobs sniffed before.
+
+    Saved under the git directory a line per blob, and loaded when first
+    needed. New entries are appended, until there are more than
+    MIME_CACHE_MAX_ENTRIES, when the file starts afresh with just this run's
+    entries. That's done once per run, so a run with more files than that
+    still saves them all.
+    """
+
+    def __init__(self):
+        """Prepare to load the saved cache."""
+        self.path = None
+        self.entries = None
+        self.added = {}  # This run's entries
+        self.pruned = False
+
+    def get(self, blob_sha):
+        """Return the saved (mime_type, binary) of a blob, or None."""
+        if self.entries is None:
+            self.path = os.path.join(cache_dir(), MIME_CACHE_NAME)
+            self.entries = {}
+            try:
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        # Entries from before binary files were noted have 2
+                        # fields, and are sniffed again
+                        fields = line.split()
+                        if len(fields) == 3:
+                            self.entries[fields[0]] = (fields[1],
+                                                       fields[2] == 'binary')
+            except IOError:
+                pass
+        return self.entries.get(blob_sha)
+
+    def save(self, new_entries):
+        """Save new_entries, pruning the cache if it's too big."""
+        self.added.update(new_entries)
+        if not self.pruned and len(self.entries) + len(new_entries) > \
+                MIME_CACHE_MAX_ENTRIES:
+            self.pruned = True
+            self.entries = dict(self.added)
+            mode, new_entries = 'w', self.added
+        else:
+            self.entries.update(new_entries)
+            mode = 'a'
+        try:
+            with open(self.path, mode) as f:
+                for blob_sha, (mime_type, binary) in new_entries.iteritems():
+                    f.write("%s %s %s\n" % (blob_sha, mime_type,
+                                            'binary' if binary else 'text'))
+        except IOError as err:
+            logging.debug("Couldn't save MIME cache %s (%s)", self.path, err)
+
+
+def known_mime_type(staged_file, cache):
+    """Return staged_file's (mime_type, binary) if it needn't be sniffed.
+
+    Otherwise None. cache is the MimeCache.
+    """
+    cached = cache.get(staged_file.blob_sha)
+    if cached:
+        return cached
+    extension = os.path.splitext(staged_file.path)[1].lower()
+    if extension in EXTENSION_MIME_TYPES:
+        return (EXTENSION_MIME_TYPES[extension], True)
+    if staged_file.large:
+        return (UNKNOWN_MIME_TYPE, False)
+    return None
+
+
+def detect_mime_types(files, cache=None, jobs=1):
+    """Return {blob_sha: (mime_type, binary)} for StagedFiles.
+
+    Results are cached by blob, so content is only sniffed the first time
+    it's seen. Files with a trusted extension (all binary formats) aren't
+    sniffed at all, and nor are large files, which are
+    application/octet-stream unless their extension is trusted. Sniffed
+    content is kept as the files' content rather than written to disk, and
+    sniffed in-process if possible, or else by up to jobs `file` runs at
+    once (see MimeSniffer). cache is the MimeCache to use, by default a new
+    one.
+    """
+    cache = cache or MimeCache()
+    mime_types = {}
+    unknown = {}  # blob_sha: StagedFile
+    for staged_file in files:
+        blob_sha = staged_file.blob_sha
+        if blob_sha in mime_types or blob_sha in unknown:
+            continue
+        known = known_mime_type(staged_file, cache)
+        if known:
+            mime_types[blob_sha] = known
+        else:
+            unknown[blob_sha] = staged_file
+    read_blobs([(staged_file, False, True)
+                for staged_file in unknown.itervalues()
+                if staged_file.content is None])
+    for blob_sha, staged_file in unknown.items():
+        if staged_file.error:
+            mime_types[blob_sha] = (UNKNOWN_MIME_TYPE, False)
+            del unknown[blob_sha]
+    new_entries = {}
+    try:
+        if unknown and MIME_SNIFFER.in_process():
+            jobs = 1  # Nothing to gain from threads
+        for blob_sha, mime_type in run_parallel(
+                lambda blob_sha: MIME_SNIFFER.sniff(unknown[blob_sha].content),
+                list(unknown), jobs):
+            new_entries[blob_sha] = mime_type
+    except OSError as err:
+        logging.info("Couldn't determine MIME types (\"%s\").", err)
+    if new_entries:  # Failures aren't saved, file may work next time
+        cache.save(new_entries)
+    mime_types.update(new_entries)
+    for blob_sha in unknown:
+        mime_types.setdefault(blob_sha, (UNKNOWN_MIME_TYPE, False))
+    logging.debug("Sniffed MIME types of %s/%s files.", len(unknown),
+                  len(files))
+    return mime_types
 
 
 def plugin_install(path):
@@ -246,27 +2242,281 @@ def plugin_install(path):
         logging.error("%s failed during setup. Output:\n%s", path, e.output)
 
 
-def plugin_check(path, real_file, temp_file, mime_type, env):
-    """Run plugin and return (veto, output)."""
-    args = (path, 'check', real_file, temp_file, mime_type)
+def wait_process(process):
+    """Wait for process to exit and return its resource usage.
+
+    Sets process.returncode, as Popen.wait() would.
+    """
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return usage
+
+
+def write_stdin(process, content):
+    """Send content to process's stdin from a thread, then close it.
+
+    Return the thread. A process that exits without reading everything
+    isn't an error.
+    """
+    return write_pipe(process.stdin, content)
+
+
+def write_pipe(pipe, content):
+    """Write content to the pipe file object from a thread, then close it.
+
+    Return the thread. A reader that stops early isn't an error.
+    """
+    def write():
+        """Write the content, ignoring a closed pipe."""
+        try:
+            pipe.write(content)
+        except IOError as err:
+            if err.errno not in (errno.EPIPE, errno.EINVAL):
+                raise
+        finally:
+            try:
+                pipe.close()
+            except IOError:
+                pass
+
+    thread = threading.Thread(target=write)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_plugin(plugin, args, staged_file=None, timeout=(None, None),
+               output=None, **trace_args):
+    """Run a Plugin's action, args[0], and return (returncode, output).
+
+    When checking a staged_file, the plugin gets that file's environment,
+    and its content on stdin if the plugin reads it from there. timeout is
+    (seconds, reason) from TimeBudget.timeout(). A run that takes too long
+    is killed, and PluginTimeout raised. Raises Cancelled if plugins were
+    stopped. Output is read a line at a time into output, a PluginOutput
+    (by default one with the default limit). The plugin's resource limits
+    apply (see PluginProcesses.start()). The run is traced with trace_args
+    as extra information.
+    """
+    output = output or PluginOutput()
+    content = staged_file.content \
+        if staged_file is not None and plugin.stdin else None
+    args = (plugin.path,) + tuple(args)
+    start = time.time()
     try:
         logging.debug("Running %s", args)
-        plugin = subprocess.Popen(args,
-                                  stderr=subprocess.STDOUT,
-                                  stdout=subprocess.PIPE,
-                                  env=env)
+        process = PROCESSES.start(
+            args,
+            stdin=subprocess.PIPE if content is not None else None,
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE,
+            env=plugin.env if staged_file is None
+            else plugin.file_env(staged_file),
+            limits=plugin.limits)
     except OSError as err:
-        logging.warning("Couldn't run %s (%s), skipping.", plugin, err)
-        return (False, '')
-    output, _ = plugin.communicate()
-    if plugin.returncode == PENDER_EXIT_OK:
-        return (False, output)
-    elif plugin.returncode == PENDER_EXIT_VETO:
-        return (True, output)
-    else:
+        logging.warning("Couldn't run %s (%s), skipping.", plugin.path, err)
+        return (PENDER_EXIT_ERR, '')
+    watchdog = Watchdog(process, timeout[0])
+    if content is not None:
+        writer = write_stdin(process, content)
+    # Bounded reads, so one huge line can't take all our memory
+    for line in iter(lambda: process.stdout.readline(65536), ''):
+        output.add(line)
+    output = output.value()
+    if content is not None:
+        writer.join()
+    process.stdout.close()
+    # Rather than communicate(), so we get this process's own usage
+    usage = wait_process(process)
+    timed_out = watchdog.stop()
+    PROCESSES.finished(process)
+    TRACER.add('%s %s' % (plugin.name, args[1]), start,
+               time.time() - start, usage, returncode=process.returncode,
+               timed_out=timed_out, **trace_args)
+    if PROCESSES.stopped:
+        raise Cancelled()
+    if timed_out:
+        raise PluginTimeout(output, timeout[1])
+    if process.returncode == -signal.SIGXCPU:
+        if output and not output.endswith('\n'):
+            output += '\n'
+        output += "%s was killed (max_cpu_seconds reached).\n" % \
+            plugin.name
+    return (process.returncode, output)
+
+
+def plugin_check(plugin, staged_file, timeout=(None, None), output=None):
+    """Run a Plugin's check action on a StagedFile.
+
+    Return (returncode, output). The content is sent to the plugin's stdin
+    if it reads it from there. Raises PluginTimeout if the plugin runs past
+    timeout, and output is collected in output (see run_plugin()).
+    """
+    returncode, output = run_plugin(
+        plugin, ('check', staged_file.path, plugin.temp_file(staged_file),
+                 staged_file.mime_type), staged_file, timeout, output,
+        file=staged_file.path)
+    if returncode not in (PENDER_EXIT_OK, PENDER_EXIT_VETO):
         logging.warning("%s returned unexpected exit code %s, skipping.",
-                        plugin, plugin.returncode)
-        return (False, output)
+                        plugin.path, returncode)
+    return (returncode, output)
+
+
+def plugin_check_batch(plugin, staged_files, timeout=(None, None),
+                       output=None):
+    """Run a plugin's check-batch action over several files.
+
+    Return a list of (returncode, output), one per file. Files the plugin
+    didn't return a verdict for are treated as plugin errors. Raises
+    PluginTimeout if the plugin runs past timeout, and the run's own output
+    is collected in output (see run_plugin()).
+
+    JSON can't hold paths that aren't UTF-8, so if there are any, each file
+    is checked with the check action instead, within the same timeout.
+    """
+    try:
+        manifest = json.dumps([plugin.request(staged_file)
+                               for staged_file in staged_files])
+    except UnicodeDecodeError:
+        logging.debug("%s: paths aren't all UTF-8, checking files one at a "
+                      "time.", plugin.name)
+        return plugin_check_each(plugin, staged_files, timeout)
+    manifest_fd, manifest_path = tempfile.mkstemp(prefix='pender-manifest-')
+    results_fd, results_path = tempfile.mkstemp(prefix='pender-results-')
+    os.close(results_fd)
+    try:
+        with os.fdopen(manifest_fd, 'w') as f:
+            f.write(manifest)
+        returncode, output = run_plugin(
+            plugin, ('check-batch', manifest_path, results_path),
+            timeout=timeout, output=output,
+            files=[staged_file.path for staged_file in staged_files])
+        try:
+            with open(results_path, 'r') as f:
+                verdicts = json.load(f) if returncode == PENDER_EXIT_OK \
+                    else {}
+        except (IOError, ValueError) as err:
+            logging.warning("Couldn't read %s batch results (%s).",
+                            plugin.name, err)
+            verdicts = {}
+    finally:
+        os.unlink(manifest_path)
+        os.unlink(results_path)
+
+    if returncode != PENDER_EXIT_OK:
+        logging.warning("%s check-batch returned unexpected exit code %s, "
+                        "skipping.", plugin.name, returncode)
+    elif output:
+        logging.debug("%s check-batch output:\n%s", plugin.name, output)
+    return batch_results(plugin, staged_files, verdicts, output)
+
+
+def plugin_check_each(plugin, staged_files, timeout=(None, None)):
+    """Run a plugin's check action on each of staged_files in turn.
+
+    Return a list of (returncode, output), one per file. The files share
+    timeout, and PluginTimeout is raised once it runs out.
+    """
+    deadline = None if timeout[0] is None else time.time() + timeout[0]
+    results = []
+    for staged_file in staged_files:
+        if deadline is not None:
+            timeout = (deadline - time.time(), timeout[1])
+            if timeout[0] <= 0:
+                raise PluginTimeout('', timeout[1])
+        results.append(plugin_check(plugin, staged_file, timeout))
+    return results
+
+
+def batch_results(plugin, staged_files, verdicts, output):
+    """Return a (returncode, output) per file from check-batch's verdicts.
+
+    verdicts are the results file's, by path. Files without one are plugin
+    errors, with the run's output.
+    """
+    results = []
+    for staged_file in staged_files:
+        verdict = verdicts.get(staged_file.path.decode('utf-8', 'replace'))
+        if verdict is None:
+            results.append((PENDER_EXIT_ERR, output))
+            continue
+        result = (verdict.get('returncode', PENDER_EXIT_ERR),
+                  verdict.get('output', '').encode('utf-8'))
+        if result[0] not in (PENDER_EXIT_OK, PENDER_EXIT_VETO):
+            logging.warning("%s returned unexpected exit code %s for %s, "
+                            "skipping.", plugin.name, result[0],
+                            staged_file.path)
+        results.append(result)
+    return results
+
+
+def run_parallel(func, items, jobs):
+    """Call func on each item using up to jobs threads.
+
+    items may be any iterable, and is only read as threads are free, under
+    a lock. Yield (item, result) pairs in completion order. An exception
+    raised by func or items is re-raised here and stops any further items
+    being started.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    items = iter(items)
+    lock = threading.Lock()
+    done = Queue.Queue()
+    stop = threading.Event()
+    finished = object()  # Queued as each thread exits
+
+    def worker():
+        """Process items until there are none left or we're stopped."""
+        try:
+            while not stop.is_set():
+                with lock:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                try:
+                    done.put((item, func(item), None))
+                except Exception as err:  # pylint: disable=broad-except
+                    done.put((item, None, err))
+        except Exception as err:  # pylint: disable=broad-except
+            done.put((None, None, err))  # From items
+        finally:
+            done.put(finished)
+
+    for _ in range(jobs):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    running = jobs
+    try:
+        while running:
+            # Poll with a timeout, Python 2 can't interrupt a blocking get()
+            try:
+                entry = done.get(True, 0.1)
+            except Queue.Empty:
+                continue
+            if entry is finished:
+                running -= 1
+                continue
+            item, result, err = entry
+            if err is not None:
+                raise err
+            yield item, result
+    finally:
+        stop.set()
 
 
 def plugin_env(plugin_path, plugin_config):
@@ -276,10 +2526,12 @@ def plugin_env(plugin_path, plugin_config):
         env = os.environ.copy()
         if plugin_config[name]:
             for key, value in plugin_config[name].iteritems():
-                if isinstance(value, str):
-                    val = str(value)
+                if isinstance(value, bool):
+                    val = 'true' if value else 'false'
+                elif isinstance(value, list):
+                    val = ','.join(str(item) for item in value)
                 else:
-                    val = ','.join(value)
+                    val = str(value)
                 env["PENDER_%s" % key] = val
                 logging.debug("Added %s=%s to environment for %s", key,
                               repr(val), name)
@@ -288,68 +2540,1278 @@ def plugin_env(plugin_path, plugin_config):
     return env
 
 
-def process_changed_files(temp_tree, plugin_dir, plugin_config):
-    """Process each changed file."""
-    errors = 0
-    for index_file in changed_files():
-        logging.debug("Checking %s...", index_file)
+class ReportQueue(object):
+    # pylint: disable=too-many-instance-attributes
+    """Collects check results and reports files in commit order.
+
+    Files are numbered in the order they're added. A file is reported once
+    all its checks, and those of every file before it, have finished, and
+    is then forgotten (and its temp file deleted). Results may be added from
+    any thread.
+    """
+
+    def __init__(self, plugin_list, verdicts=None):
+        """Prepare to report on files checked by plugin_list.
+
+        If verdicts is a list, a description of each file reported is added
+        to it (see record()).
+        """
+        self.verdicts = verdicts
+        self.plugins = plugin_list
+        self.lock = threading.RLock()
+        # By file number, until the file's reported
+        self.files = {}
+        self.results = {}
+        self.remaining = {}
+        self.count = 0  # Files added
+        self.finished = 0  # Files with all results
+        self.shown = set()  # (file, plugin) numbers with output shown live
+        self.next_file = 0
+        self.errors = 0
+        self.vetoed = False  # Whether any plugin has vetoed a file yet
+
+    def add_files(self, files, applicable):
+        """Add StagedFiles to report on, and return the first one's number.
+
+        applicable lists the numbers of the plugins checking each file.
+        """
+        with self.lock:
+            first = self.count
+            for file_num, (staged_file, plugin_nums) in enumerate(
+                    zip(files, applicable), first):
+                self.files[file_num] = staged_file
+                self.results[file_num] = [None] * len(self.plugins)
+                self.remaining[file_num] = \
+                    0 if staged_file.error else len(plugin_nums)
+                if not self.remaining[file_num]:
+                    self.finished += 1
+            self.count += len(files)
+            return first
+
+    def add(self, file_num, plugin_num, result, shown=False):
+        """Record a plugin's (returncode, output) for a file.
+
+        If shown, the output was already logged as the plugin ran.
+        """
+        with self.lock:
+            self.results[file_num][plugin_num] = result
+            self.remaining[file_num] -= 1
+            if not self.remaining[file_num]:
+                self.finished += 1
+            if shown:
+                self.shown.add((file_num, plugin_num))
+            if result[0] == PENDER_EXIT_VETO:
+                self.vetoed = True
+
+    def flush(self):
+        """Report every file that's ready."""
+        with self.lock:
+            while self.next_file < self.count and \
+                    not self.remaining[self.next_file]:
+                self.report(self.next_file)
+                self.next_file += 1
+
+    def report(self, file_num):
+        """Report a file and forget it."""
+        staged_file = self.files[file_num]
+        if staged_file.error:
+            logging.error(staged_file.error)
+            failed = True
+        else:
+            failed = self.report_file(file_num)
+        if failed:
+            self.errors += 1
+        if self.verdicts is not None:
+            self.verdicts.append(self.record(file_num, failed))
+        staged_file.discard()
+        for plugin_num in range(len(self.plugins)):
+            self.shown.discard((file_num, plugin_num))
+        del self.files[file_num], self.results[file_num], \
+            self.remaining[file_num]
+
+    def flush_early(self):
+        """Report what's known after checks were stopped early.
+
+        Files with all their checks done, or a veto, are reported. Return
+        how many files were skipped because their checks hadn't finished.
+        """
+        with self.lock:
+            skipped = 0
+            for file_num in range(self.next_file, self.count):
+                if self.remaining[file_num] and not any(
+                        result and result[0] == PENDER_EXIT_VETO
+                        for result in self.results[file_num]):
+                    skipped += 1
+                    self.files[file_num].discard()
+                    continue
+                self.report(file_num)
+            self.next_file = self.count
+            return skipped
+
+    def record(self, file_num, failed):
+        """Describe a file's verdicts for a machine-readable report."""
+        staged_file = self.files[file_num]
+        verdict = {
+            'path': staged_file.path.decode('utf-8', 'replace'),
+            'blob': staged_file.blob_sha,
+            'error': str(staged_file.error) if staged_file.error else None,
+            'failed': failed,
+            'checks': [{'plugin': plugin.name,
+                        'returncode': result[0],
+                        'output': result[1].decode('utf-8', 'replace')}
+                       for plugin, result in zip(self.plugins,
+                                                 self.results[file_num])
+                       if result is not None],
+        }
+        if staged_file.commit:
+            verdict['commit'] = staged_file.commit
+        return verdict
+
+    def report_file(self, file_num):
+        """Log the plugin results for one file. Return True if vetoed."""
+        staged_file = self.files[file_num]
+        vetoed = False
+        for plugin_num, (plugin, result) in enumerate(
+                zip(self.plugins, self.results[file_num])):
+            if result is None:  # Plugin doesn't apply
+                continue
+            returncode, output = result
+            shown = (file_num, plugin_num) in self.shown
+            if returncode == PENDER_EXIT_VETO:
+                vetoed = True
+                logging.error("%s vetoes %s%s", plugin.name,
+                              staged_file.describe(),
+                              " (output above)" if shown else ":")
+            if not shown:
+                for line in output.splitlines():
+                    logging.info(line)
+        return vetoed
+
+
+def report_unchecked(unchecked, size_limit):
+    """Log the files which plugins skipped for being large or binary.
+
+    unchecked is a list of (StagedFile, reason, [plugin names]). Large files
+    are warned about, as they're often committed by mistake; size_limit is
+    the size in bytes they're over.
+    """
+    for staged_file, reason, names in unchecked:
+        if reason == 'large':
+            logging.warning("Not checking %s with %s: %.1f MB is over "
+                            "max_file_size_kb (%s).", staged_file.path,
+                            ", ".join(names), staged_file.size / 2.0**20,
+                            size_limit // 1024)
+        else:
+            logging.info("Not checking %s with %s: %s is binary.",
+                         staged_file.path, ", ".join(names),
+                         staged_file.mime_type)
+
+
+class CheckSettings(collections.namedtuple('CheckSettings', (
+        'jobs', 'budget', 'throttle', 'fail_fast', 'stream_output',
+        'output_limit', 'max_file_size'))):
+    """How checks are run, from the config's pender section."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, pender_config):
+        """Read the settings in pender_config.
+
+        Raises PenderError if a setting is invalid.
+        """
+        return cls(job_count(pender_config), time_budget(pender_config),
+                   throttle_for(pender_config),
+                   pender_config.get('fail_fast', False),
+                   pender_config.get('stream_output', False),
+                   output_limit(pender_config), max_file_size(pender_config))
+
+
+def lookup_files(entries, selection, temp_tree, size_limit):
+    """Return StagedFiles for selected files, with their blobs looked up.
+
+    entries are from selection.files(). Pushed files are kept apart under a
+    directory per commit in temp_tree. Files over size_limit bytes are
+    marked large.
+    """
+    paths = [path for path, _, _ in entries]
+    if selection.push is None:
+        blobs = staged_blobs(paths, selection.revision)
+    else:
+        blobs = blob_info([blob_sha for _, _, blob_sha in entries], paths)
+    files = [StagedFile(index_file,
+                        os.path.join(temp_tree, commit or '',
+                                     index_file.lstrip('/')),
+                        blob, commit)
+             for (index_file, commit, _), blob in zip(entries, blobs)]
+    for staged_file in files:
+        staged_file.large = staged_file.size is not None and \
+            staged_file.size > size_limit
+    return files
+
+
+def detect_files(files, index, mime_cache, jobs):
+    """Set the MIME type of each of files a plugin in index might check."""
+    sniffed = [staged_file for staged_file in files
+               if not staged_file.error and index.may_check(staged_file.path)]
+    mime_types = detect_mime_types(sniffed, mime_cache, jobs)
+    for staged_file in sniffed:
+        staged_file.mime_type, staged_file.binary = \
+            mime_types[staged_file.blob_sha]
+    return files
+
+
+def file_pipeline(entries, threaded, temp_tree, settings, preparer):
+    """Start the Stages files flow through, and return them.
+
+    entries is an iterator of chunks from selection.files(). The stages
+    list the paths, look up their blobs, detect MIME types, then prepare
+    each chunk with preparer, a ChunkPreparer, so the last stage yields
+    Chunks. If threaded, each stage runs in its own thread.
+    """
+    first_entries = next(entries)
+    mime_cache = MimeCache()
+    stages = [Stage('changed_files', lambda chunk: chunk, entries, threaded)]
+    stages.append(Stage(
+        'staged_blobs',
+        lambda chunk: lookup_files(chunk, preparer.selection, temp_tree,
+                                   settings.max_file_size),
+        itertools.chain([first_entries], stages[-1]), threaded))
+    stages.append(Stage(
+        'detect_mime_types',
+        lambda files: detect_files(files, preparer.index, mime_cache,
+                                   settings.jobs),
+        stages[-1], threaded))
+    stages.append(Stage('create_temp_files', preparer.prepare, stages[-1],
+                        threaded))
+    return stages
+
+
+class SharedChecks(object):
+    """Checks shared between pushed files with the same content.
+
+    Pushed commits often share content, so each blob is only checked once
+    by each plugin at each path, and the verdict shared with every commit
+    that has it. Plugins may check a file by its path (eg its extension),
+    as the result cache allows, so checks are keyed by (blob SHA-1, path,
+    plugin number). Unless enabled (when checking a push), nothing is
+    shared.
+    """
+
+    def __init__(self, enabled):
+        """Start with no checks claimed."""
+        self.enabled = enabled
+        self.claimed = set()  # Checks started, or cached, in an earlier file
+        self.results = {}  # Results of those checks, once known
+        self.waiting = {}  # Numbers of the files waiting for those results
+
+    @staticmethod
+    def key(staged_file, plugin_num):
+        """Return the key of plugin plugin_num's check of staged_file."""
+        return (staged_file.blob_sha, staged_file.path, plugin_num)
+
+    def claim(self, key):
+        """Return whether the check is the caller's to run (or replay).
+
+        If not, an earlier file claimed it, so its result is shared.
+        """
+        if not self.enabled:
+            return True
+        if key in self.claimed:
+            return False
+        self.claimed.add(key)
+        return True
+
+    def release(self, key):
+        """Let a later file claim a check this one couldn't run."""
+        self.claimed.discard(key)
+
+    def share(self, report, staged_file, plugin_num, result):
+        """Pass a check's result on to files waiting for it in report.
+
+        Their output is the same, so isn't shown again. Call with the report
+        locked.
+        """
+        if not self.enabled:
+            return
+        key = self.key(staged_file, plugin_num)
+        self.results[key] = result
+        for file_num in self.waiting.pop(key, []):
+            report.add(file_num, plugin_num, result, True)
+
+    def wait(self, report, file_num, staged_file, plugin_num):
+        """Add a shared check's result for file_num to report once known.
+
+        Call with the report locked.
+        """
+        key = self.key(staged_file, plugin_num)
+        if key in self.results:
+            report.add(file_num, plugin_num, self.results[key], True)
+        else:
+            self.waiting.setdefault(key, []).append(file_num)
+
+
+class Chunk(collections.namedtuple('Chunk', (
+        'files', 'applicable', 'cached', 'todo', 'shares'))):
+    """A chunk of files, and what's to be done to check them.
+
+    applicable lists the numbers of the plugins checking each file, cached
+    the (file index, plugin number, result)s replayed from the result cache,
+    todo the file indexes each plugin must check, and shares the (file
+    index, plugin number)s sharing an earlier file's check (see
+    SharedChecks).
+    """
+
+    __slots__ = ()
+
+
+class ChunkPreparer(object):
+    """Decides which plugins check each chunk of files, and reads them.
+
+    Chunks are prepared in order, by the pipeline's last stage. Plugins
+    skipping files for being large or binary are listed in unchecked.
+    """
+
+    def __init__(self, plugin_list, selection, cache, shared):
+        """Prepare files from selection for plugin_list.
+
+        cache is the ResultCache or None, and shared the SharedChecks.
+        """
+        self.plugins = plugin_list
+        self.index = PluginIndex(plugin_list)
+        self.selection = selection
+        self.cache = cache
+        self.shared = shared
+        self.unchecked = []  # (StagedFile, reason, [plugin names])
+        self.ranges = None  # Changed lines, diffed when a plugin wants them
+
+    def prepare(self, files):
+        """Return a Chunk of files, with the content its checks need read."""
+        chunk = Chunk(files, [self.applicable(staged_file)
+                              for staged_file in files],
+                      [], [[] for _ in self.plugins], [])
+        self.set_changed_lines(chunk)
+        owners = self.plan(chunk)
+        self.read(chunk, owners)
+        return chunk
+
+    def applicable(self, staged_file):
+        """Return the numbers of the plugins that will check staged_file."""
+        if staged_file.error:
+            return []
+        plugin_nums = []
+        skipped = {}  # reason: [plugin names]
+        for plugin_num in self.index.plugins_for(staged_file):
+            reason = self.plugins[plugin_num].skips(staged_file)
+            if reason:
+                skipped.setdefault(reason, []).append(
+                    self.plugins[plugin_num].name)
+            else:
+                plugin_nums.append(plugin_num)
+        self.unchecked.extend((staged_file, reason, names)
+                              for reason, names in sorted(skipped.iteritems()))
+        logging.debug("Plugins for %s: %s", staged_file.path, ", ".join(
+            self.plugins[plugin_num].name
+            for plugin_num in plugin_nums) or "none")
+        return plugin_nums
+
+    def set_changed_lines(self, chunk):
+        """Tell the chunk's files their changed lines, if a plugin wants them.
+
+        Only diffs if a plugin that will run uses the changed lines.
+        """
+        if not any('changed-lines' in self.plugins[plugin_num].inputs
+                   for plugin_nums in chunk.applicable
+                   for plugin_num in plugin_nums):
+            return
+        if self.ranges is None:
+            with TRACER.phase('changed_lines'):
+                self.ranges = self.selection.changed_lines()
+        for staged_file in chunk.files:
+            staged_file.changed_lines = self.ranges.get(staged_file.path)
+
+    def plan(self, chunk):
+        """Sort the chunk's checks into cached, shared and to do.
+
+        Return the file index of each check claimed in this chunk, by its
+        SharedChecks key.
+        """
+        owners = {}
+        for file_idx, staged_file in enumerate(chunk.files):
+            for plugin_num in chunk.applicable[file_idx]:
+                key = SharedChecks.key(staged_file, plugin_num)
+                if not self.shared.claim(key):
+                    chunk.shares.append((file_idx, plugin_num))
+                    continue
+                result = self.cached_result(staged_file, plugin_num)
+                if result:
+                    chunk.cached.append((file_idx, plugin_num, result))
+                    continue
+                owners[key] = file_idx
+                chunk.todo[plugin_num].append(file_idx)
+        return owners
+
+    def cached_result(self, staged_file, plugin_num):
+        """Return the cached result of a check, or None to run it."""
+        if not self.cache:
+            return None
+        plugin = self.plugins[plugin_num]
+        result = self.cache.get(plugin.cache_key(staged_file),
+                                plugin.temp_file(staged_file))
+        if result:
+            logging.debug("Using cached result of %s for %s", plugin.name,
+                          staged_file.path)
+        return result
+
+    def read(self, chunk, owners):
+        """Read the content the chunk's checks need, dropping unread files."""
+        files = chunk.files
+        wanted = {}  # file index: [write temp file, keep content]
+        for plugin_num, plugin in enumerate(self.plugins):
+            for file_idx in chunk.todo[plugin_num]:
+                needs = wanted.setdefault(file_idx, [False, False])
+                needs[1 if plugin.stdin else 0] = True
+        read_blobs([(files[file_idx], write_temp_file and
+                     not files[file_idx].written, keep_content)
+                    for file_idx, (write_temp_file, keep_content) in
+                    sorted(wanted.iteritems())])
+        # Forget content that was only read to sniff its MIME type
+        for file_idx, staged_file in enumerate(files):
+            if not wanted.get(file_idx, (False, False))[1]:
+                staged_file.content = None
+        self.drop_unread(chunk, owners)
+
+    def drop_unread(self, chunk, owners):
+        """Drop the chunk's checks of files that couldn't be read.
+
+        Content that can't be read can't be shared either, so nor are the
+        checks claimed for it (owners is from plan()).
+        """
+        files = chunk.files
+        for file_idxs in chunk.todo:
+            file_idxs[:] = [file_idx for file_idx in file_idxs
+                            if not files[file_idx].error]
+        for key, file_idx in owners.iteritems():
+            if files[file_idx].error:
+                self.shared.release(key)
+        for file_idx, plugin_num in chunk.shares:
+            owner = owners.get(SharedChecks.key(files[file_idx], plugin_num))
+            if owner is not None and files[owner].error:
+                files[file_idx].error = files[owner].error
+        chunk.shares[:] = [share for share in chunk.shares
+                           if not files[share[0]].error]
+
+
+class CheckRunner(object):
+    """Runs checks: a plugin against one file, or a batch of them.
+
+    Called from up to settings.jobs threads at once (see run_parallel()).
+    Plugins supporting serve are started once (per concurrent check) and
+    sent each file in turn.
+    """
+
+    def __init__(self, plugin_list, report, settings, cache=None):
+        """Run checks of files in report, a ReportQueue.
+
+        settings are the CheckSettings. Results are saved in cache, a
+        ResultCache, if given.
+        """
+        self.plugins = plugin_list
+        self.report = report
+        self.settings = settings
+        self.cache = cache
+        self.servers = dict((plugin_num, PluginServer(plugin))
+                            for plugin_num, plugin in enumerate(plugin_list)
+                            if 'serve' in plugin.actions and
+                            'check-batch' not in plugin.actions)
+
+    def run(self, task):
+        """Run a (plugin number, [file number]) check.
+
+        Return (results, whether their output was logged as it arrived).
+        """
+        plugin = self.plugins[task[0]]
+        task_files = [self.report.files[file_num] for file_num in task[1]]
+        settings = self.settings
+        settings.throttle.start(plugin)
+        timeout = settings.budget.timeout(plugin, len(task_files))
+        output = PluginOutput(settings.output_limit)
+        PROGRESS.plugin_started(plugin.name)
         try:
-            temp_file = create_temp_file(temp_tree, index_file)
-        except PenderError as e:
-            logging.error(e)
-            errors += 1
-            continue
-        mime_type = get_mime_type(index_file)
-
-        plugin_errors = False
-        for plugin in plugins(plugin_dir):
-            env = plugin_env(plugin, plugin_config)
-            veto, output = plugin_check(plugin, index_file, temp_file,
-                                        mime_type, env)
-            if veto:
-                plugin_errors = True
-                logging.error("%s vetoes %s:", os.path.basename(plugin),
-                              index_file)
-            for line in output.splitlines():
-                logging.info(line)
-        if plugin_errors:
-            errors += 1
-
-    if errors:
-        logging.error("Found errors in %s files, aborting commit.", errors)
+            if timeout[0] is not None and timeout[0] <= 0:
+                raise PluginTimeout('', timeout[1])
+            results = self.check(task[0], task_files, timeout, output)
+        except PluginTimeout as err:
+            return (self.timed_out(plugin, task_files, err, output.prefix),
+                    output.prefix is not None)
+        finally:
+            PROGRESS.plugin_finished(plugin.name)
+            settings.throttle.finish(plugin)
+        self.finished(plugin, task_files, results, output.prefix is None)
+        return results, settings.stream_output
+
+    def check(self, plugin_num, task_files, timeout, output):
+        """Return the results of plugin plugin_num checking task_files.
+
+        Output of plugins run once per file is collected in output, and
+        streamed with the plugin and file as its prefix if stream_output is
+        set.
+        """
+        plugin = self.plugins[plugin_num]
+        if 'check-batch' in plugin.actions:
+            return plugin_check_batch(plugin, task_files, timeout, output)
+        if plugin_num in self.servers:
+            return [self.servers[plugin_num].check(task_files[0], timeout)]
+        if self.settings.stream_output:
+            output.prefix = '%s %s' % (plugin.name, task_files[0].path)
+        return [plugin_check(plugin, task_files[0], timeout, output)]
+
+    def finished(self, plugin, task_files, results, unstreamed):
+        """Stream and cache the results of a check that finished in time.
+
+        unstreamed is whether the output wasn't streamed as the plugin ran.
+        """
+        if self.settings.stream_output and unstreamed:
+            # Batch and serve output is only known once a file's done
+            for staged_file, (_, output) in zip(task_files, results):
+                stream_lines(output, self.settings.output_limit,
+                             '%s %s' % (plugin.name, staged_file.path))
+        if self.cache:
+            for staged_file, result in zip(task_files, results):
+                self.cache.put(plugin.cache_key(staged_file),
+                               plugin.temp_file(staged_file), *result)
+
+    def timed_out(self, plugin, task_files, err, prefix):
+        """Record a check cut off by the TimeBudget, and return its results.
+
+        If its output was streamed, under prefix, the kill is too.
+        """
+        self.settings.budget.record(plugin, task_files, err.reason)
+        message = "%s was killed (%s)." % (plugin.name, err.reason)
+        if prefix is not None:
+            logging.info("%s: %s", prefix, message)
+        output = err.output
+        if output and not output.endswith('\n'):
+            output += '\n'
+        output += message + '\n'
+        return [(PENDER_EXIT_ERR, output)] * len(task_files)
+
+    def close(self):
+        """Stop the serve plugins."""
+        for server in self.servers.values():
+            server.close()
+
+
+class CheckScheduler(object):
+    """Turns prepared chunks into checks, and reports their results.
+
+    Plugins supporting check-batch get a batch per chunk, or the only chunk
+    split across jobs. Other plugins get a check per file. Results are
+    added to report, a ReportQueue, and shared with pushed files having the
+    same content by shared, the SharedChecks.
+    """
+
+    def __init__(self, report, shared, settings, only_chunk):
+        """Schedule checks of report's plugins, settings.jobs at a time.
+
+        settings are the CheckSettings. If only_chunk, there's just the one
+        chunk to check.
+        """
+        self.plugins = report.plugins
+        self.report = report
+        self.shared = shared
+        self.settings = settings
+        self.only_chunk = only_chunk
+        self.count = 0  # Checks scheduled
+
+    def run(self, runner, chunks):
+        """Run the checks of chunks with runner, a CheckRunner.
+
+        Return whether checking stopped early, at a veto with fail_fast.
+        """
+        # Prepare the first chunk now, so its checks can start straight away
+        chunks = iter(chunks)
+        chunks = itertools.chain([next(chunks)], chunks)
+        jobs = self.settings.jobs
+        with TRACER.phase('checks', jobs=jobs) as trace_args:
+            for task, (results, shown) in run_parallel(
+                    runner.run, self.tasks(chunks), jobs):
+                if self.finish(task, results, shown):
+                    break
+            trace_args['tasks'] = self.count
+        return self.settings.fail_fast and self.report.vetoed
+
+    def tasks(self, chunks):
+        """Yield (plugin number, [file number]) checks as chunks are ready.
+
+        Cached results are reported as each chunk is added.
+        """
+        for chunk_num, chunk in enumerate(chunks):
+            first = self.add(chunk)
+            if self.settings.fail_fast and self.report.vetoed:
+                return  # By a cached veto
+            tasks = self.split(chunk, first)
+            if chunk_num == 0:
+                self.set_jobs(len(tasks))
+            self.count += len(tasks)
+            for task in tasks:
+                yield task
+
+    def add(self, chunk):
+        """Add a chunk's files to the report, with the results known already.
+
+        Return the first file's number.
+        """
+        report = self.report
+        first = report.add_files(chunk.files, chunk.applicable)
+        with report.lock:
+            for file_idx, plugin_num, result in chunk.cached:
+                staged_file = chunk.files[file_idx]
+                if not staged_file.error:  # Else already finished
+                    report.add(first + file_idx, plugin_num, result)
+                    self.shared.share(report, staged_file, plugin_num, result)
+            for file_idx, plugin_num in chunk.shares:
+                self.shared.wait(report, first + file_idx,
+                                 chunk.files[file_idx], plugin_num)
+            report.flush()
+        PROGRESS.set_done(report.finished, report.count)
+        return first
+
+    def split(self, chunk, first):
+        """Return the checks to run for a chunk whose first file is first.
+
+        The long batch runs come first, then single checks in file order so
+        the first files can be reported early.
+        """
+        batches = []
+        checks = []
+        for plugin_num, plugin in enumerate(self.plugins):
+            file_nums = [first + file_idx
+                         for file_idx in chunk.todo[plugin_num]]
+            if 'check-batch' in plugin.actions and file_nums:
+                if self.only_chunk:
+                    # Round up
+                    size = -(-len(file_nums) // self.settings.jobs)
+                else:
+                    size = len(file_nums)
+                batches.extend((plugin_num, file_nums[i:i + size])
+                               for i in range(0, len(file_nums), size))
+            else:
+                checks.extend((plugin_num, [file_num])
+                              for file_num in file_nums)
+        return batches + sorted(checks, key=lambda task: task[1])
+
+    def set_jobs(self, count):
+        """Tell plugins how many checks run at once, of the first count.
+
+        So plugins with their own parallelism can share the CPUs.
+        """
+        jobs = self.settings.jobs
+        running = max(1, min(jobs, count)) if self.only_chunk else jobs
+        for plugin in self.plugins:
+            plugin.env = dict(plugin.env, PENDER_JOBS=str(running))
+
+    def finish(self, task, results, shown):
+        """Report a finished check's results. Return whether to stop.
+
+        shown is whether their output was logged as the check ran.
+        """
+        report = self.report
+        plugin_num, file_nums = task
+        with report.lock:
+            for file_num, result in zip(file_nums, results):
+                self.shared.share(report, report.files[file_num], plugin_num,
+                                  result)
+                report.add(file_num, plugin_num, result, shown)
+            report.flush()
+        PROGRESS.set_done(report.finished, report.count)
+        return self.settings.fail_fast and report.vetoed
+
+
+def add_verdicts(verdicts, report, unchecked, budget):
+    """Extend verdicts with what wasn't reported per file (see write_report()).
+
+    report is the ReportQueue, unchecked is from the ChunkPreparer, and
+    budget is the TimeBudget.
+    """
+    verdicts['errors'] += report.errors
+    verdicts['unchecked'].extend(
+        {'path': staged_file.path.decode('utf-8', 'replace'),
+         'reason': reason, 'plugins': names}
+        for staged_file, reason, names in unchecked)
+    verdicts['cut_off'].extend(
+        {'plugin': name,
+         'paths': [path.decode('utf-8', 'replace') for path in paths],
+         'reason': reason}
+        for name, paths, reason in budget.cut_off)
+
+
+def run_pipeline(stages, scheduler, runner):
+    """Run the checks of the chunks from the last of stages.
+
+    Return whether checking stopped early (see CheckScheduler.run()), when
+    any plugins still running are killed. The stages, and runner's serve
+    plugins, are stopped either way.
+    """
+    stopped_early = False
+    PROGRESS.start()
+    try:
+        stopped_early = scheduler.run(runner, stages[-1])
+    finally:
+        PROGRESS.stop()
+        for stage in stages:
+            stage.stop()
+        if stopped_early:
+            PROCESSES.stop()
+        runner.close()
+    return stopped_early
+
+
+def load_plugins(config):
+    """Return the Plugins in the configured plugin_dir, in name order."""
+    pender_config = config['pender']
+    return [Plugin(path, config['plugins'],
+                   pender_config.get('plugin_settings'))
+            for path in sorted(plugins(pender_config['plugin_dir']))]
+
+
+def process_changed_files(temp_tree, config, cache=None, selection=None,
+                          verdicts=None):
+    """Process each changed file.
+
+    The files, and which version of them is checked, come from selection, a
+    Selection (by default the staged changes). How they're checked comes
+    from config (see CheckSettings).
+
+    Files flow through a pipeline in chunks of PIPELINE_CHUNK_SIZE (see
+    file_pipeline()): listing the paths, looking up their blobs, detecting
+    MIME types, then reading the content plugins need. If there's more than
+    one chunk, each stage runs in its own thread, a few chunks ahead of the
+    next at most, so git is still listing and reading later files while
+    earlier ones are checked, and memory doesn't grow with the number of
+    files. Files are forgotten, and their temp files deleted, once reported.
+
+    Each file is only checked by the plugins that apply to it. Checks are run
+    jobs at a time (see CheckScheduler and CheckRunner), but results are
+    reported per file in commit order. If cache is given, saved verdicts
+    are replayed instead of running the plugin. Plugin runs are limited by
+    the TimeBudget; checks that are cut off count as plugin errors. Checks
+    are held back while the machine is busy by the Throttle. With
+    fail_fast, checking stops at the first veto, killing any plugins still
+    running.
+
+    Each plugin run's output is limited to max_output_kb. With
+    stream_output, plugin output is logged as soon as it's known, prefixed
+    with the plugin and file, instead of with the verdict: as it arrives
+    from plugins run once per file, as each serve reply arrives, and as each
+    batch run finishes.
+
+    Staged content is only read for files a plugin will check, or might
+    check depending on their MIME type, which is detected from the content
+    in memory. It's written to temp files under temp_tree only for
+    plugins that don't read it from stdin. Files over max_file_size_kb
+    aren't read to detect their MIME type, and they and binary files are
+    only checked by plugins that ask for them. Files skipped this way are
+    listed at the end.
+
+    If verdicts is a dict, its 'files', 'unchecked' and 'cut_off' lists are
+    extended, and 'errors' counted, for a machine-readable report (see
+    write_report()).
+    """
+    settings = CheckSettings.from_config(config['pender'])
+    selection = selection or Selection()
+    entries = chunked(selection.files(), PIPELINE_CHUNK_SIZE)
+    with TRACER.phase('changed_files') as trace_args:
+        first_entries = next(entries, [])
+        trace_args['count'] = len(first_entries)
+    if not first_entries:
+        return GIT_EXIT_OK  # Nothing to check, so don't load the plugins
+    # A short first chunk is the only one, and not worth starting threads for
+    threaded = len(first_entries) == PIPELINE_CHUNK_SIZE
+    preparer = ChunkPreparer(load_plugins(config), selection, cache,
+                             SharedChecks(selection.push is not None))
+    stages = file_pipeline(itertools.chain([first_entries], entries),
+                           threaded, temp_tree, settings, preparer)
+    report = ReportQueue(preparer.plugins,
+                         None if verdicts is None else verdicts['files'])
+    scheduler = CheckScheduler(report, preparer.shared, settings,
+                               not threaded)
+    if run_pipeline(stages, scheduler,
+                    CheckRunner(preparer.plugins, report, settings, cache)):
+        logging.warning("Stopped checking after a veto (fail_fast), skipped "
+                        "%s files.", report.flush_early())
+    report_unchecked(preparer.unchecked, settings.max_file_size)
+    settings.budget.summary()
+    if verdicts is not None:
+        add_verdicts(verdicts, report, preparer.unchecked, settings.budget)
+    if report.errors:
+        logging.error("Found errors in %s files, aborting %s.",
+                      report.errors,
+                      'commit' if selection.push is None else 'push')
         return GIT_EXIT_VETO
-    else:
-        return GIT_EXIT_OK
+    return GIT_EXIT_OK
+
+
+def new_report(selection):
+    """Return an empty report on checking selection (see write_report())."""
+    return {
+        'mode': selection.mode,
+        'base': selection.base,
+        'revision': selection.revision,
+        'shards': [selection.shard or (1, 1)],
+        'errors': 0,
+        'files': [],
+        'unchecked': [],
+        'cut_off': [],
+    }
+
+
+def write_report(path, report):
+    """Save a verdict report as JSON.
+
+    report is {'mode', 'base', 'revision', 'shards', 'errors', 'files',
+    'unchecked', 'cut_off'}, filled in by process_changed_files().
+    """
+    try:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    except IOError as err:
+        raise PenderError("Couldn't write report to %s (%s)" % (path, err))
+    logging.info("Wrote report to %s", path)
+
+
+def merge_reports(paths):
+    """Return one report combining the reports of several shards.
+
+    Files are sorted by path. Missing or repeated shards are warned about.
+    """
+    merged = None
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                report = json.load(f)
+        except (IOError, ValueError) as err:
+            raise PenderError("Couldn't read report %s (%s)" % (path, err))
+        if merged is None:
+            merged = dict(report, shards=[], errors=0, files=[],
+                          unchecked=[], cut_off=[])
+        elif (report['mode'], report['base'], report['revision']) != \
+                (merged['mode'], merged['base'], merged['revision']):
+            logging.warning("%s checked different files (%s %s..%s) to the "
+                            "first report.", path, report['mode'],
+                            report['base'], report['revision'])
+        for key in ('shards', 'files', 'unchecked', 'cut_off'):
+            merged[key].extend(report[key])
+        merged['errors'] += report['errors']
+    merged['files'].sort(key=lambda verdict: verdict['path'])
+    shards = sorted(tuple(shard) for shard in merged['shards'])
+    counts = set(count for _, count in shards)
+    if len(counts) != 1 or \
+            shards != [(i, shards[0][1]) for i in range(1, len(shards) + 1)]:
+        logging.warning("Reports don't cover each shard once (got %s).",
+                        ", ".join('%s/%s' % shard for shard in shards))
+    return merged
+
+
+def parse_shard(value):
+    """Parse a shard like '2/4' into (2, 4)."""
+    try:
+        shard, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid shard %r, expected i/N" %
+                                         value)
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError("Shard %r out of range" % value)
+    return (shard, count)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Pender pre-commit hook. Run without arguments to "
+        "install it in this repository.")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="delete cached check results and exit")
+    files = parser.add_mutually_exclusive_group()
+    files.add_argument('--all-files', action='store_true',
+                       help="check every tracked file, as staged, and exit "
+                       "(eg in CI)")
+    files.add_argument('--range', metavar='A..B',
+                       help="check the files added or modified between two "
+                       "commits, as of the second, and exit. A...B diffs "
+                       "from their merge base")
+    files.add_argument('--pre-push', nargs='*', metavar='REMOTE',
+                       help="check the files added or modified by each "
+                       "commit being pushed, as listed on stdin by git's "
+                       "pre-push hook, and exit. Pass the hook's arguments "
+                       "to skip commits on the remote's branches")
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help="with --all-files, --range or --pre-push, only "
+                        "check the I'th of N slices of the files")
+    parser.add_argument('--report', metavar='PATH',
+                        help="with --all-files, --range or --pre-push, save "
+                        "every verdict to PATH as JSON. With --merge-reports, "
+                        "save the merged report there instead of printing it")
+    parser.add_argument('--merge-reports', nargs='+', metavar='REPORT',
+                        help="combine the --report files of each shard and "
+                        "exit, failing if any file failed")
+    daemon = parser.add_mutually_exclusive_group()
+    daemon.add_argument('--daemon', action='store_true',
+                        help="start a background process which checks files "
+                        "as they're staged, so the hook can reuse the "
+                        "verdicts, and exit")
+    daemon.add_argument('--stop-daemon', action='store_true',
+                        help="stop the background process and exit")
+    args = parser.parse_args()
+    if (args.shard or args.report) and not (args.all_files or args.range or
+                                            args.pre_push is not None or
+                                            args.merge_reports):
+        parser.error("--shard and --report need --all-files, --range or "
+                     "--pre-push")
+    return args
+
+
+def select_files(args=None):
+    """Return the Selection of files chosen by args, by default staged ones.
+
+    None if there's nothing to check, as a push only deletes branches.
+    """
+    if args is None:
+        return Selection()
+    push = None
+    if args.pre_push is not None:
+        push = parse_push(sys.stdin, (args.pre_push or [None])[0])
+        if push is None:
+            return None
+    return Selection(args.all_files, args.range, args.shard, push)
+
+
+def run_checks(config, args=None):
+    """Check the staged changes, or the files chosen by args in CI.
+
+    Return the exit code.
+    """
+    pender_config = config['pender']
+    report_path = args and args.report
+    temp_tree = tempfile.mkdtemp()
+    try:
+        selection = select_files(args)
+        if selection is None:
+            return GIT_EXIT_OK  # Only deleting branches
+        report = new_report(selection)
+        cache = result_cache(pender_config)
+        if cache:
+            max_age, max_size = cache_limits(pender_config)
+        with TRACER.phase('pre-commit'):
+            rc = process_changed_files(temp_tree, config, cache, selection,
+                                       report if report_path else None)
+        if cache:
+            cache.prune(max_age, max_size)
+        if report_path:
+            write_report(report_path, report)
+    except KeyboardInterrupt:
+        PROCESSES.stop()
+        sys.stdout.flush()
+        rc = GIT_EXIT_VETO
+    except PenderError as e:
+        logging.error(e)
+        rc = GIT_EXIT_VETO
+    finally:
+        shutil.rmtree(temp_tree)
+    trace_path = os.environ.get('PENDER_TRACE', pender_config.get('trace'))
+    if trace_path:
+        TRACER.save(trace_path)
+    return rc
+
+
+class IndexWatcher(object):
+    """Waits for git's index file to change.
+
+    Uses inotify on Linux (through ctypes, as Python 2 has no module for it),
+    or polls the file's inode, size and mtime elsewhere.
+    """
+
+    def __init__(self, path):
+        """Start watching the index file at path."""
+        self.path = path
+        self.stamp = self.stat()
+        self.fd = None
+        try:
+            import ctypes  # Only needed here
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            # git renames a new index into place, so watch the directory
+            if libc.inotify_add_watch(
+                    fd, os.path.dirname(os.path.abspath(path)),
+                    INOTIFY_CLOSE_WRITE | INOTIFY_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (AttributeError, OSError) as err:
+            logging.debug("Polling %s, as inotify isn't available (%s)",
+                          path, err)
+
+    def stat(self):
+        """Return the index's (inode, size, mtime), or None if it's gone."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def wait(self, timeout):
+        """Return whether the index changed within timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if self.fd is None:
+                stamp = self.stat()
+                if stamp != self.stamp:
+                    self.stamp = stamp
+                    return True
+                if remaining <= 0:
+                    return False
+                time.sleep(min(DAEMON_POLL_INTERVAL, remaining))
+                continue
+            if remaining <= 0 or \
+                    not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            events = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(events):
+                # struct inotify_event: wd, mask, cookie, len, then the name
+                length = struct.unpack_from('iIII', events, offset)[3]
+                name = events[offset + 16:offset + 16 + length].rstrip('\0')
+                offset += 16 + length
+                if name == os.path.basename(self.path):
+                    return True
+
+
+def daemon_pid():
+    """Return the pid of this repository's daemon, or None if not running.
+
+    The daemon holds a lock on its pid file for as long as it runs.
+    """
+    try:
+        with open(os.path.join(cache_dir(), DAEMON_PID_NAME), 'r') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                return int(f.read())
+    except (IOError, ValueError):
+        pass  # Not started, or only just starting
+    return None
+
+
+def start_daemon(config):
+    """Start the daemon in the background, unless it's running already.
+
+    Return its pid. It logs to DAEMON_LOG_NAME in the cache directory.
+    """
+    pid = daemon_pid()
+    if pid:
+        return pid
+    log_path = os.path.join(cache_dir(), DAEMON_LOG_NAME)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read_end, write_end = os.pipe()
+    child = os.fork()
+    if not child:
+        run_daemon(config, log_path, read_end, write_end)  # Never returns
+    os.close(write_end)
+    with os.fdopen(read_end, 'r') as f:
+        pid = f.read()  # Sent by the daemon once it's detached
+    os.waitpid(child, 0)
+    return int(pid) if pid else None
+
+
+def run_daemon(config, log_path, read_end, write_end):
+    """Detach from the hook and run the daemon, in start_daemon()'s child.
+
+    The daemon's pid is written to the pipe write_end, and it logs to
+    log_path. Exits when the daemon stops.
+    """
+    rc = PENDER_EXIT_ERR
+    try:
+        # Leave the hook's session, so git and the terminal don't wait for
+        # or signal us, and fork again so we're not a session leader
+        os.close(read_end)
+        os.setsid()
+        if os.fork():
+            os._exit(PENDER_EXIT_OK)  # pylint: disable=protected-access
+        os.write(write_end, str(os.getpid()))
+        os.close(write_end)
+        null = os.open(os.devnull, os.O_RDONLY)
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                      os.O_APPEND, 0o600)
+        os.dup2(null, 0)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        os.close(null)
+        os.close(log)
+        os.nice(DAEMON_NICENESS)
+        rc = watch_index(config)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception("The daemon failed.")
+    finally:
+        os._exit(rc)  # pylint: disable=protected-access
+
+
+def stop_daemon():
+    """Stop this repository's daemon, if it's running."""
+    pid = daemon_pid()
+    if not pid:
+        logging.info("The daemon isn't running.")
+        return
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError as err:
+        raise PenderError("Couldn't stop the daemon (%s)" % err)
+    logging.info("Stopped the daemon (pid %s).", pid)
+
+
+def interrupt(signum, frame):
+    """Handle SIGTERM like Ctrl-C."""
+    # pylint: disable=unused-argument
+    raise KeyboardInterrupt()
+
+
+def watch_index(config):
+    """Check the staged changes each time the index changes, until stopped.
+
+    Verdicts are saved in the result cache, where the hook finds them, so
+    files staged a little before committing aren't checked again. Runs
+    until there have been no changes for daemon_idle_minutes, Pender is
+    updated, or it's stopped (with SIGTERM or Ctrl-C). Return the exit code.
+    """
+    pid_file = open(os.path.join(cache_dir(), DAEMON_PID_NAME), 'a+')
+    try:
+        fcntl.flock(pid_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logging.info("The daemon is already running.")
+        return PENDER_EXIT_OK
+    pid_file.truncate(0)
+    pid_file.write(str(os.getpid()))
+    pid_file.flush()
+    signal.signal(signal.SIGTERM, interrupt)
+    # Started by the hook, git may have pointed us at a temporary index
+    os.environ.pop('GIT_INDEX_FILE', None)
+    os.environ.pop('PENDER_TRACE', None)
+    idle = daemon_idle_time(config['pender'])
+    watcher = IndexWatcher(os.path.join(git_dir(), 'index'))
+    pender = os.path.abspath(sys.argv[0])
+    version = os.stat(pender).st_mtime
+    logging.info("Daemon %s watching %s", os.getpid(), watcher.path)
+    try:
+        while True:
+            # Let a burst of `git add`s finish first
+            while watcher.wait(DAEMON_SETTLE_TIME):
+                pass
+            if os.stat(pender).st_mtime != version:
+                logging.info("%s has been updated, stopping.", pender)
+                break
+            if os.fstat(1).st_size > DAEMON_LOG_MAX_SIZE:
+                os.ftruncate(1, 0)
+            logging.info("Checking the staged changes.")
+            config = load_config() or config
+            del TRACER.events[:]
+            # Every file is wanted, and the hook has its own time limit
+            run_checks(dict(config, pender=dict(
+                config['pender'], fail_fast=False, commit_timeout=None,
+                stream_output=False, trace=None)))
+            if PROCESSES.stopped:  # Interrupted
+                break
+            if not watcher.wait(idle):
+                logging.info("No changes for %g minutes, stopping.",
+                             idle / 60)
+                break
+    except KeyboardInterrupt:
+        PROCESSES.stop()
+    except PenderError as e:
+        logging.error(e)
+        return PENDER_EXIT_ERR
+    finally:
+        pid_file.close()
+    return PENDER_EXIT_OK
+
+
+def merge_command(paths, report_path=None):
+    """Merge the shard reports at paths (--merge-reports).
+
+    The merged report is written to report_path, or stdout. Return the exit
+    code.
+    """
+    try:
+        merged = merge_reports(paths)
+        if report_path:
+            write_report(report_path, merged)
+        else:
+            json.dump(merged, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+    except PenderError as e:
+        logging.error(e)
+        return PENDER_EXIT_ERR
+    return GIT_EXIT_VETO if merged['errors'] else GIT_EXIT_OK
+
+
+def daemon_command(config, stop=False):
+    """Start the daemon (--daemon), or stop it. Return the exit code."""
+    try:
+        if stop:
+            stop_daemon()
+        elif not result_cache(config['pender']):
+            raise PenderError("The daemon needs the cache enabled.")
+        else:
+            daemon_idle_time(config['pender'])  # Fail now if it's invalid
+            logging.info("Daemon running (pid %s), logging to %s",
+                         start_daemon(config),
+                         os.path.join(cache_dir(), DAEMON_LOG_NAME))
+    except PenderError as e:
+        logging.error(e)
+        return PENDER_EXIT_ERR
+    return PENDER_EXIT_OK
 
 
 def main():
     """Main application."""
+    args = parse_args()
     initialise_logging()
+    if args.merge_reports:
+        sys.exit(merge_command(args.merge_reports, args.report))
     try:
-        config = load_config()
+        with TRACER.phase('load_config'):
+            config = load_config()
     except PenderError as e:
         logging.error(e)
         sys.exit(GIT_EXIT_VETO)
     if config['pender'].get('debug'):
         logging.root.setLevel(logging.DEBUG)
 
-    if 'GIT_DIR' not in os.environ:
-        rc = install_check(config['pender']['plugin_dir'])
-    else:
-        autoupdate_check()
+    if args.clear_cache:
         try:
-            temp_tree = tempfile.mkdtemp()
-            rc = process_changed_files(temp_tree,
-                                       config['pender']['plugin_dir'],
-                                       config['plugins'])
-        except KeyboardInterrupt:
-            sys.stdout.flush()
-            rc = GIT_EXIT_VETO
+            clear_caches()
+            rc = PENDER_EXIT_OK
         except PenderError as e:
             logging.error(e)
-            rc = GIT_EXIT_VETO
-        finally:
-            shutil.rmtree(temp_tree)
+            rc = PENDER_EXIT_ERR
+    elif args.daemon or args.stop_daemon:
+        rc = daemon_command(config, args.stop_daemon)
+    elif args.all_files or args.range or args.pre_push is not None:
+        rc = run_checks(config, args)
+    elif 'GIT_DIR' not in os.environ:
+        rc = install_check(config['pender']['plugin_dir'])
+    else:
+        autoupdate_check()
+        rc = run_checks(config)
+        if config['pender'].get('daemon') and \
+                result_cache(config['pender']):
+            # Check files as they're staged for the next commit
+            try:
+                start_daemon(config)
+            except (PenderError, OSError) as e:
+                logging.warning("Couldn't start the daemon (%s)", e)
     sys.exit(rc)
 
 
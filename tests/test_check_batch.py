@@ -0,0 +1,82 @@
+"""Tests for running check-batch plugins.
+
+Run with `python -m unittest discover tests` (Python 2).
+"""
+
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+
+PENDER = imp.load_source('pender', os.path.join(
+    os.path.dirname(__file__), '..', 'pre-commit.py'))
+
+# Vetoes files containing BAD, saying which action was used
+BATCH_PLUGIN = r'''#!/usr/bin/env python
+# pender-actions: check-batch
+import sys
+import json
+
+
+def check(temp_file):
+    with open(temp_file) as f:
+        return 10 if 'BAD' in f.read() else 0
+
+if sys.argv[1] == 'check':
+    print 'check'
+    sys.exit(check(sys.argv[3]))
+elif sys.argv[1] == 'check-batch':
+    with open(sys.argv[2]) as f:
+        manifest = json.load(f)
+    results = {}
+    for request in manifest:
+        results[request['file']] = {
+            'returncode': check(request['temp_file'].encode('utf-8')),
+            'output': 'check-batch\n'}
+    with open(sys.argv[3], 'w') as f:
+        json.dump(results, f)
+'''
+
+
+class CheckBatchTest(unittest.TestCase):
+    """Tests for plugin_check_batch()."""
+
+    def setUp(self):
+        """Write the plugin."""
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'batch.py')
+        with open(path, 'w') as f:
+            f.write(BATCH_PLUGIN)
+        os.chmod(path, 0o755)
+        self.plugin = PENDER.Plugin(path, {})
+
+    def tearDown(self):
+        """Delete the plugin and files."""
+        shutil.rmtree(self.dir)
+
+    def staged_file(self, path, content):
+        """Return a StagedFile for path, written with content."""
+        temp_file = os.path.join(self.dir, path)
+        with open(temp_file, 'w') as f:
+            f.write(content)
+        return PENDER.StagedFile(path, temp_file, ('0' * 40, None, None))
+
+    def test_batch(self):
+        """Check UTF-8 paths in one batch."""
+        results = PENDER.plugin_check_batch(self.plugin, [
+            self.staged_file('good\xc3\xa9.txt', 'ok\n'),
+            self.staged_file('bad.txt', 'BAD\n')])
+        self.assertEqual(results, [(0, 'check-batch\n'),
+                                   (10, 'check-batch\n')])
+
+    def test_non_utf8_path(self):
+        """Check paths JSON can't hold one at a time."""
+        results = PENDER.plugin_check_batch(self.plugin, [
+            self.staged_file('good.txt', 'ok\n'),
+            self.staged_file('bad\xe9.txt', 'BAD\n')])
+        self.assertEqual(results, [(0, 'check\n'), (10, 'check\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Tests for merging the reports of sharded runs.
+
+Run with `python -m unittest discover tests` (Python 2).
+"""
+
+import os
+import imp
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+PENDER = imp.load_source('pender', os.path.join(
+    os.path.dirname(__file__), '..', 'pre-commit.py'))
+
+
+class Warnings(logging.Handler):
+    """Collects the warnings logged."""
+
+    def __init__(self):
+        """Start with none."""
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        """Keep a warning's message."""
+        self.messages.append(record.getMessage())
+
+
+class MergeReportsTest(unittest.TestCase):
+    """Tests for merge_reports()."""
+
+    def setUp(self):
+        """Collect warnings instead of logging them."""
+        self.dir = tempfile.mkdtemp()
+        self.warnings = Warnings()
+        self.handlers = logging.root.handlers
+        logging.root.handlers = [self.warnings]
+
+    def tearDown(self):
+        """Delete the reports."""
+        logging.root.handlers = self.handlers
+        shutil.rmtree(self.dir)
+
+    def report(self, shard, paths, errors=0, revision='b' * 40):
+        """Write a shard's report on paths, and return its path."""
+        path = os.path.join(self.dir, '%s-of-%s.json' % tuple(shard))
+        with open(path, 'w') as f:
+            json.dump({
+                'mode': 'range',
+                'base': 'a' * 40,
+                'revision': revision,
+                'shards': [shard],
+                'errors': errors,
+                'files': [{'path': file_path, 'failed': False}
+                          for file_path in paths],
+                'unchecked': [],
+                'cut_off': [],
+            }, f)
+        return path
+
+    def test_merge(self):
+        """Combine every shard's files, sorted, and count their errors."""
+        merged = PENDER.merge_reports([
+            self.report([2, 2], ['d', 'b'], 1),
+            self.report([1, 2], ['c', 'a'], 2)])
+        self.assertEqual([verdict['path'] for verdict in merged['files']],
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(merged['errors'], 3)
+        self.assertEqual(sorted(merged['shards']), [[1, 2], [2, 2]])
+        self.assertEqual(merged['revision'], 'b' * 40)
+        self.assertEqual(self.warnings.messages, [])
+
+    def test_missing_shard(self):
+        """Warn when a shard is missing or repeated."""
+        PENDER.merge_reports([self.report([1, 3], ['a']),
+                              self.report([3, 3], ['b'])])
+        self.assertEqual(self.warnings.messages, [
+            "Reports don't cover each shard once (got 1/3, 3/3)."])
+
+    def test_different_revision(self):
+        """Warn when shards checked different commits."""
+        PENDER.merge_reports([self.report([1, 2], ['a']),
+                              self.report([2, 2], ['b'], revision='c' * 40)])
+        self.assertEqual(len(self.warnings.messages), 1)
+        self.assertIn('checked different files',
+                      self.warnings.messages[0])
+
+    def test_unreadable(self):
+        """Fail on a report that can't be read."""
+        with self.assertRaises(PENDER.PenderError):
+            PENDER.merge_reports([os.path.join(self.dir, 'missing.json')])
+
+
+if __name__ == '__main__':
+    unittest.main()
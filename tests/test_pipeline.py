@@ -0,0 +1,180 @@
+"""Tests for the order files are checked and reported in.
+
+Run with `python -m unittest discover tests` (Python 2).
+"""
+
+import os
+import imp
+import shutil
+import logging
+import tempfile
+import unittest
+
+PENDER = imp.load_source('pender', os.path.join(
+    os.path.dirname(__file__), '..', 'pre-commit.py'))
+
+
+class PipelineTestCase(unittest.TestCase):
+    """Base class writing plugins and files to a temp directory."""
+
+    def setUp(self):
+        """Make the temp directory, and quieten the reports."""
+        self.dir = tempfile.mkdtemp()
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        """Delete the temp directory."""
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.dir)
+
+    def plugin(self, name, header):
+        """Return a Plugin that does nothing, with header lines."""
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n%s\nexit 0\n' % header)
+        os.chmod(path, 0o755)
+        return PENDER.Plugin(path, {})
+
+    def staged_file(self, path, blob_sha, commit=None):
+        """Return a StagedFile for path, with its content in memory."""
+        staged_file = PENDER.StagedFile(
+            path, os.path.join(self.dir, 'tree', commit or '', path),
+            (blob_sha, 1, None), commit)
+        staged_file.content = 'x'
+        return staged_file
+
+    @staticmethod
+    def settings(jobs=1, fail_fast=False):
+        """Return CheckSettings with no limits."""
+        return PENDER.CheckSettings(jobs, PENDER.TimeBudget(),
+                                    PENDER.Throttle(), fail_fast, False,
+                                    PENDER.PLUGIN_OUTPUT_LIMIT,
+                                    PENDER.MAX_FILE_SIZE)
+
+
+class ReportQueueTest(PipelineTestCase):
+    """Tests for ReportQueue."""
+
+    def test_commit_order(self):
+        """Report files in order, however their results arrive."""
+        plugins = [self.plugin('a', ''), self.plugin('b', '')]
+        verdicts = []
+        report = PENDER.ReportQueue(plugins, verdicts)
+        report.add_files([self.staged_file(path, '1' * 40)
+                          for path in ('x', 'y', 'z')],
+                         [[0, 1], [0], [1]])
+        report.add(2, 1, (0, ''))
+        report.add(0, 1, (0, ''))
+        report.flush()
+        self.assertEqual(verdicts, [])
+        report.add(0, 0, (0, ''))
+        report.flush()
+        self.assertEqual([verdict['path'] for verdict in verdicts], ['x'])
+        report.add(1, 0, (10, 'bad\n'))
+        report.flush()
+        self.assertEqual([(verdict['path'], verdict['failed'])
+                          for verdict in verdicts],
+                         [('x', False), ('y', True), ('z', False)])
+        self.assertEqual(report.errors, 1)
+        self.assertTrue(report.vetoed)
+
+    def test_flush_early(self):
+        """Report vetoes, and skip unfinished files, after fail_fast."""
+        plugins = [self.plugin('a', ''), self.plugin('b', '')]
+        verdicts = []
+        report = PENDER.ReportQueue(plugins, verdicts)
+        report.add_files([self.staged_file(path, '1' * 40)
+                          for path in ('x', 'y', 'z')],
+                         [[0, 1], [0, 1], [0]])
+        report.add(1, 0, (10, 'bad\n'))
+        report.add(2, 0, (0, ''))
+        self.assertEqual(report.flush_early(), 1)
+        self.assertEqual([verdict['path'] for verdict in verdicts],
+                         ['y', 'z'])
+
+
+class StageTest(PipelineTestCase):
+    """Tests for Stage."""
+
+    def test_order(self):
+        """Yield results in order, threaded or not."""
+        for threaded in (True, False):
+            stage = PENDER.Stage('test', lambda chunk: [n * 2 for n in chunk],
+                                 iter([[1, 2], [3]]), threaded)
+            self.assertEqual(list(stage), [[2, 4], [6]])
+
+    def test_error(self):
+        """Re-raise the stage's exceptions."""
+        def fail(_):
+            """Fail like a stage might."""
+            raise PENDER.PenderError('failed')
+
+        stage = PENDER.Stage('test', fail, iter([[1]]), True)
+        with self.assertRaises(PENDER.PenderError):
+            list(stage)
+
+
+class CheckSchedulerTest(PipelineTestCase):
+    """Tests for CheckScheduler."""
+
+    def test_split(self):
+        """Start batches first, then single checks in file order."""
+        plugins = [self.plugin('batch', '# pender-actions: check-batch'),
+                   self.plugin('each', '')]
+        report = PENDER.ReportQueue(plugins)
+        scheduler = PENDER.CheckScheduler(
+            report, PENDER.SharedChecks(False), self.settings(jobs=2), True)
+        chunk = PENDER.Chunk([], [], [], [[0, 1, 2], [2, 0]], [])
+        self.assertEqual(scheduler.split(chunk, 10), [
+            (0, [10, 11]), (0, [12]), (1, [10]), (1, [12])])
+
+
+class SharedChecksTest(PipelineTestCase):
+    """Tests for checking the same pushed content once."""
+
+    def prepare(self, shared, files):
+        """Return a prepared Chunk of files, checked by a .txt plugin."""
+        plugin = self.plugin('txt', '# pender-extensions: .txt')
+        preparer = PENDER.ChunkPreparer([plugin], PENDER.Selection(), None,
+                                        shared)
+        return preparer.prepare(files)
+
+    def test_push(self):
+        """Share a check of the same blob at the same path only."""
+        files = [self.staged_file('a.txt', '1' * 40, 'c1'),
+                 self.staged_file('a.txt', '1' * 40, 'c2'),
+                 self.staged_file('b.txt', '1' * 40, 'c2'),
+                 self.staged_file('a.txt', '2' * 40, 'c3')]
+        chunk = self.prepare(PENDER.SharedChecks(True), files)
+        self.assertEqual(chunk.todo, [[0, 2, 3]])
+        self.assertEqual(chunk.shares, [(1, 0)])
+
+    def test_not_push(self):
+        """Share nothing when not checking a push."""
+        files = [self.staged_file('a.txt', '1' * 40),
+                 self.staged_file('a.txt', '1' * 40)]
+        chunk = self.prepare(PENDER.SharedChecks(False), files)
+        self.assertEqual(chunk.todo, [[0, 1]])
+        self.assertEqual(chunk.shares, [])
+
+    def test_shared_result(self):
+        """Report the shared result for each file once it's known."""
+        shared = PENDER.SharedChecks(True)
+        files = [self.staged_file('a.txt', '1' * 40, 'c1'),
+                 self.staged_file('a.txt', '1' * 40, 'c2')]
+        chunk = self.prepare(shared, files)
+        verdicts = []
+        report = PENDER.ReportQueue(
+            [self.plugin('txt', '# pender-extensions: .txt')], verdicts)
+        scheduler = PENDER.CheckScheduler(report, shared, self.settings(),
+                                          True)
+        self.assertEqual(scheduler.add(chunk), 0)
+        scheduler.finish((0, [0]), [(10, 'bad\n')], False)
+        self.assertEqual([(verdict['commit'], verdict['failed'])
+                          for verdict in verdicts],
+                         [('c1', True), ('c2', True)])
+        self.assertEqual(report.errors, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Tests for the result cache.
+
+Run with `python -m unittest discover tests` (Python 2).
+"""
+
+import os
+import imp
+import time
+import shutil
+import tempfile
+import unittest
+
+PENDER = imp.load_source('pender', os.path.join(
+    os.path.dirname(__file__), '..', 'pre-commit.py'))
+
+
+class ResultCacheTest(unittest.TestCase):
+    """Tests for ResultCache."""
+
+    def setUp(self):
+        """Start with an empty cache."""
+        self.dir = tempfile.mkdtemp()
+        self.cache = PENDER.ResultCache(os.path.join(self.dir, 'results'))
+        self.file = PENDER.StagedFile('a.txt', '/tmp/x/a.txt',
+                                      ('1' * 40, 3, None))
+
+    def tearDown(self):
+        """Delete the cache."""
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        """Replay a verdict, with the temp file path updated."""
+        key = self.cache.key(self.file, 'digest')
+        self.cache.put(key, '/tmp/x/a.txt', 10, 'bad in /tmp/x/a.txt\n')
+        self.assertEqual(self.cache.get(key, '/tmp/y/a.txt'),
+                         (10, 'bad in /tmp/y/a.txt\n'))
+
+    def test_plugin_errors_not_saved(self):
+        """Retry plugin errors every time."""
+        key = self.cache.key(self.file, 'digest')
+        self.cache.put(key, '/tmp/x/a.txt', 1, 'no linter\n')
+        self.assertIsNone(self.cache.get(key, '/tmp/x/a.txt'))
+
+    def test_key_changes(self):
+        """Miss when the blob, path, plugin or changed lines differ."""
+        key = self.cache.key(self.file, 'digest')
+        others = [
+            PENDER.StagedFile('a.txt', None, ('2' * 40, 3, None)),
+            PENDER.StagedFile('b.txt', None, ('1' * 40, 3, None)),
+        ]
+        keys = [self.cache.key(staged_file, 'digest')
+                for staged_file in others]
+        keys.append(self.cache.key(self.file, 'other digest'))
+        keys.append(self.cache.key(self.file, 'digest', [(1, 2)]))
+        self.assertNotIn(key, keys)
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_plugin_digest(self):
+        """Change the plugin digest with its PENDER_* settings only."""
+        plugin = os.path.join(self.dir, 'plugin')
+        with open(plugin, 'w') as f:
+            f.write('#!/bin/sh\n')
+        digest = self.cache.plugin_digest(plugin, {'PENDER_X': 'a'})
+        self.assertEqual(self.cache.plugin_digest(
+            plugin, {'PENDER_X': 'a', 'HOME': '/'}), digest)
+        self.assertNotEqual(self.cache.plugin_digest(
+            plugin, {'PENDER_X': 'b'}), digest)
+
+    def test_prune(self):
+        """Delete old entries, then the least recently used over size."""
+        keys = [self.cache.key(self.file, str(i)) for i in range(3)]
+        for key in keys:
+            self.cache.put(key, '/tmp/x/a.txt', 0, 'x' * 100)
+        now = time.time()
+        for age, key in zip((1000, 20, 10), keys):
+            os.utime(os.path.join(self.cache.path, key[:2], key[2:]),
+                     (now - age, now - age))
+        self.cache.prune(500, 150)
+        self.assertEqual([self.cache.get(key, '') is not None
+                          for key in keys], [False, False, True])
+
+
+class CacheLimitsTest(unittest.TestCase):
+    """Tests for cache_limits()."""
+
+    def test_defaults(self):
+        """Keep 30 days and 50 MB by default."""
+        self.assertEqual(PENDER.cache_limits({}), (30 * 86400, 50 * 2**20))
+
+    def test_invalid(self):
+        """Reject limits that aren't positive numbers."""
+        for value in ('soon', 0, -1):
+            with self.assertRaises(PENDER.PenderError):
+                PENDER.cache_limits({'cache_max_age_days': value})
+
+
+if __name__ == '__main__':
+    unittest.main()
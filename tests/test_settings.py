@@ -0,0 +1,55 @@
+"""Tests for reading the config.
+
+Run with `python -m unittest discover tests` (Python 2).
+"""
+
+import os
+import imp
+import unittest
+
+PENDER = imp.load_source('pender', os.path.join(
+    os.path.dirname(__file__), '..', 'pre-commit.py'))
+
+
+class PluginEnvTest(unittest.TestCase):
+    """Tests for plugin_env()."""
+
+    def test_values(self):
+        """Pass plugin settings as PENDER_* strings."""
+        env = PENDER.plugin_env('/plugins/check_x.py', {'check_x': {
+            'on': True, 'off': False, 'count': 3, 'names': ['a', 1]}})
+        self.assertEqual((env['PENDER_on'], env['PENDER_off'],
+                          env['PENDER_count'], env['PENDER_names']),
+                         ('true', 'false', '3', 'a,1'))
+
+    def test_unconfigured(self):
+        """Give unconfigured plugins our own environment."""
+        env = PENDER.plugin_env('/plugins/check_y.py', {'check_x': {}})
+        self.assertNotIn('PENDER_on', env)
+
+
+class CheckSettingsTest(unittest.TestCase):
+    """Tests for CheckSettings.from_config()."""
+
+    def test_defaults(self):
+        """Use the default limits when unset."""
+        settings = PENDER.CheckSettings.from_config({'jobs': 2})
+        self.assertEqual((settings.jobs, settings.fail_fast,
+                          settings.output_limit, settings.max_file_size),
+                         (2, False, PENDER.PLUGIN_OUTPUT_LIMIT,
+                          PENDER.MAX_FILE_SIZE))
+        self.assertIsNone(settings.budget.deadline)
+
+    def test_invalid(self):
+        """Reject invalid settings."""
+        for pender_config in ({'jobs': 0}, {'plugin_timeout': 'long'},
+                              {'commit_timeout': -1},
+                              {'max_output_kb': 0},
+                              {'max_file_size_kb': 'big'},
+                              {'adaptive_jobs': 'yes'}):
+            with self.assertRaises(PENDER.PenderError):
+                PENDER.CheckSettings.from_config(pender_config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Tests for plugin time limits.
+
+Run with `python -m unittest discover tests` (Python 2).
+"""
+
+import os
+import imp
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+PENDER = imp.load_source('pender', os.path.join(
+    os.path.dirname(__file__), '..', 'pre-commit.py'))
+
+# Says it's started, then takes too long
+SLOW_PLUGIN = '''#!/bin/sh
+echo started
+sleep 10
+'''
+
+
+class TimeBudgetTest(unittest.TestCase):
+    """Tests for TimeBudget."""
+
+    def setUp(self):
+        """Write the plugin."""
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'slow')
+        with open(path, 'w') as f:
+            f.write(SLOW_PLUGIN)
+        os.chmod(path, 0o755)
+        self.plugin = PENDER.Plugin(path, {})
+
+    def tearDown(self):
+        """Delete the plugin."""
+        shutil.rmtree(self.dir)
+
+    def test_no_limit(self):
+        """Let plugins run for as long as they like by default."""
+        self.assertEqual(PENDER.TimeBudget().timeout(self.plugin),
+                         (None, None))
+
+    def test_plugin_timeout(self):
+        """Give batch runs the plugin timeout for each file."""
+        budget = PENDER.TimeBudget(plugin_timeout=2)
+        self.assertEqual(budget.timeout(self.plugin, 3),
+                         (6, 'timeout of 6s'))
+        self.plugin.timeout = 1
+        self.assertEqual(budget.timeout(self.plugin), (1, 'timeout of 1s'))
+
+    def test_commit_timeout(self):
+        """Cut runs short at the commit_timeout."""
+        budget = PENDER.TimeBudget(plugin_timeout=60, commit_timeout=0.01)
+        time.sleep(0.02)
+        seconds, reason = budget.timeout(self.plugin)
+        self.assertLessEqual(seconds, 0)
+        self.assertEqual(reason, 'commit_timeout reached')
+
+    def test_killed(self):
+        """Kill a run that takes too long, keeping its output so far."""
+        start = time.time()
+        with self.assertRaises(PENDER.PluginTimeout) as raised:
+            PENDER.run_plugin(self.plugin, ('check', 'a', 'a', 'text/plain'),
+                              timeout=(0.5, 'timeout of 0.5s'))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(raised.exception.output, 'started\n')
+        self.assertEqual(raised.exception.reason, 'timeout of 0.5s')
+
+    def test_cut_off(self):
+        """Count checks past the commit_timeout as plugin errors."""
+        budget = PENDER.TimeBudget(commit_timeout=0.01)
+        time.sleep(0.02)
+        settings = PENDER.CheckSettings(1, budget, PENDER.Throttle(), False,
+                                        False, PENDER.PLUGIN_OUTPUT_LIMIT,
+                                        PENDER.MAX_FILE_SIZE)
+        report = PENDER.ReportQueue([self.plugin])
+        report.add_files([PENDER.StagedFile('a.txt')], [[0]])
+        runner = PENDER.CheckRunner([self.plugin], report, settings)
+        logging.disable(logging.CRITICAL)
+        try:
+            results, _ = runner.run((0, [0]))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(results, [
+            (PENDER.PENDER_EXIT_ERR,
+             'slow was killed (commit_timeout reached).\n')])
+        self.assertEqual(budget.cut_off,
+                         [('slow', ['a.txt'], 'commit_timeout reached')])
+
+
+if __name__ == '__main__':
+    unittest.main()